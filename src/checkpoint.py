@@ -0,0 +1,87 @@
+import os
+import queue
+import tempfile
+import threading
+import torch
+
+
+def snapshot(obj):
+    """Copy of a (nested) state dict with every tensor copied to cpu memory"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def save_atomic(obj, path):
+    """
+    torch.save to a unique temporary file next to path that is renamed to path, so readers never see half
+    written checkpoints and concurrent writers of the same path never write to the same temporary file
+    """
+    fd, temp_path = tempfile.mkstemp(prefix=f'{os.path.basename(path)}.', suffix='.tmp',
+                                     dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            torch.save(obj, f)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class CheckpointWriter(object):
+    """
+    Saves checkpoints on a background thread. save snapshots the state dict to cpu memory and returns,
+    the snapshot is serialized (atomically) while training goes on. At most max_pending snapshots wait
+    to be written, save blocks beyond that. A callback given to save is called on the writer thread once
+    the checkpoint is written (not if writing fails). flush waits for all pending checkpoints and raises
+    write and callback errors, close also stops the thread (the next save starts a new one).
+    """
+
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = None
+        self.errors = []
+
+    def _start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._write_loop, daemon=True)
+            self.thread.start()
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            obj, path, callback = item
+            try:
+                save_atomic(obj, path)
+                if callback is not None:
+                    callback()
+            except Exception as e:
+                self.errors.append((path, e))
+            finally:
+                self.queue.task_done()
+
+    def save(self, state_dict, path, callback=None):
+        self._start()
+        self.queue.put((snapshot(state_dict), path, callback))
+
+    def flush(self):
+        self.queue.join()
+        if len(self.errors) > 0:
+            errors, self.errors = self.errors, []
+            path, error = errors[0]
+            raise IOError(f'Writing {len(errors)} checkpoint(s) failed, first at {path}') from error
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.thread = None
+        self.flush()
@@ -1,9 +1,39 @@
 import torch
+import hashlib
 import numpy as np
-from itertools import compress
+from functools import partial
 
 from torch.utils.data import Dataset, DataLoader
 
+MODES = ['train', 'validation', 'test']
+
+
+def split_by_text(data, texts, eof_train_split, eof_val_split):
+    """
+    Split data by the position of each point's text in texts with a single dict lookup per point.
+    Texts at [0, eof_train_split) go to train, [eof_train_split, eof_val_split) to validation
+    and the rest to test, so samples with the same text never end up in two splits.
+
+    Args:
+        data (list): points with a 'text' key
+        texts (list): unique texts in the order that decides the split
+    """
+    text_split = {}
+    for position, text in enumerate(texts):
+        if position < eof_train_split:
+            text_split[text] = 'train'
+        elif position < eof_val_split:
+            text_split[text] = 'validation'
+        else:
+            text_split[text] = 'test'
+
+    split_data = {mode: [] for mode in MODES}
+    for point in data:
+        split = text_split.get(point['text'])
+        if split is not None:
+            split_data[split].append(point)
+    return split_data
+
 
 class BaseDataset(Dataset):
     """Dataset Template"""
@@ -13,11 +43,24 @@ class BaseDataset(Dataset):
 
         self.mode = 'train'
         self.annotator_filter = ''
+        self.data_index = None
         self.train_val_split = argv.get('train_val_split', 0.8)
         self.device = argv.get('device', torch.device('cpu'))
         self.root_data = argv.get('data_path', '../data/')
 
         self.pseudo_labels_key = 'pseudo_labels'
+        # built on the first lookup and reset whenever annotators is assigned
+        self._annotator_index = None
+
+        # store padded token ids per sample and look up word vectors in a shared embedding matrix at batch time
+        self.use_token_ids = argv.get('use_token_ids', False)
+        self.token_vocabulary = {}
+        self.embedding_dtype = torch.long if self.use_token_ids else torch.float32
+        self._embedding_matrix = None
+
+        # keep a contiguous, array-backed copy of the split data that is indexed instead of the record lists
+        self.columnar = argv.get('columnar', False)
+        self.columns = None
 
         self._build_text_processor(**argv)
         pass
@@ -30,6 +73,10 @@ class BaseDataset(Dataset):
             from datasets.processors.word2vec import _build_text_processor, text_processor
             self.text_processor_model = _build_text_processor(**argv)
             self.text_processor_func = text_processor
+            if self.use_token_ids:
+                from datasets.processors.word2vec import token_processor, build_embedding_matrix
+                self.text_processor_func = partial(token_processor, vocabulary=self.token_vocabulary)
+                self.embedding_matrix_func = build_embedding_matrix
 
         self.text_processor_filters = []
         for f in text_processor_filters:
@@ -49,6 +96,59 @@ class BaseDataset(Dataset):
                 pass
         return self.text_processor_func(self.text_processor_model, text, **argv)
 
+    @property
+    def embedding_matrix(self):
+        """Shared word vectors of all token ids in the dataset, None if samples store word vectors"""
+        if not self.use_token_ids:
+            return None
+        if self._embedding_matrix is None or self._embedding_matrix.shape[0] != len(self.token_vocabulary) + 1:
+            self._embedding_matrix = torch.tensor(
+                self.embedding_matrix_func(self.text_processor_model, self.token_vocabulary), dtype=torch.float32)
+        return self._embedding_matrix
+
+    def share_memory(self):
+        """
+        Convert the dataset to its columnar storage and move its tensors (columns and embedding matrix) to shared
+        memory, so that worker processes read all samples from the same memory without copies. The record lists
+        are still pickled to every worker, they are only read to rebuild the columns (e.g. after pseudo labeling).
+        """
+        self.columnar = True
+        if self._get_columns() is None:
+            raise ValueError('Only datasets split into train, validation and test data can be shared')
+        self.columns.share_memory()
+        self._update_data_index()
+        if self.embedding_matrix is not None:
+            self.embedding_matrix.share_memory_()
+        return self
+
+    def _label_of(self, point):
+        return point['label']
+
+    def _embedding_of(self, point):
+        return point['embedding']
+
+    def _pseudo_labels_of(self, point):
+        if point[self.pseudo_labels_key] is None:
+            return {}
+        return point[self.pseudo_labels_key]
+
+    def _get_columns(self):
+        if self.columnar and self.columns is None and isinstance(self.data, dict):
+            self.columns = ColumnarStorage(self)
+        return self.columns
+
+    def _update_data_index(self):
+        """
+        Precompute the positions of the samples by annotator_filter in the current mode.
+        Needs to be called whenever the mode, the filter or the order of the data changes.
+        The columnar storage keeps its own index arrays.
+        """
+        if self.annotator_filter == '' or self.columnar:
+            self.data_index = None
+        else:
+            self.data_index = np.asarray([idx for idx, x in enumerate(self.data[self.mode])
+                                          if x['annotator'] == self.annotator_filter], dtype=np.int64)
+
     def data_shuffle(self, split_included=False):
         import random
         random.seed(123456789)
@@ -67,11 +167,7 @@ class BaseDataset(Dataset):
             eof_train_split = int(length * self.train_val_split * 0.9)
             eof_val_split = int(length * 0.9)
 
-            self.data = {
-                'train': [point for point in self.data if point['text'] in unique_samples[0:eof_train_split]],
-                'validation': [point for point in self.data if point['text'] in unique_samples[eof_train_split:eof_val_split]],
-                'test': [point for point in self.data if point['text'] in unique_samples[eof_val_split:]]
-            }
+            self.data = split_by_text(self.data, unique_samples, eof_train_split, eof_val_split)
 
             # length = len(self.data)
             # eof_train_split = int(length * self.train_val_split * 0.9)
@@ -83,50 +179,113 @@ class BaseDataset(Dataset):
             #     'test': self.data[eof_val_split:]
             # }
 
-        if self.annotator_filter is not '':
-            self.data_mask = [x['annotator'] == self.annotator_filter for x in self.data[self.mode]]
+        self.columns = None
+        self._update_data_index()
 
     def data_shuffle_after_split(self):
+        if self._get_columns() is not None:
+            self.columns.shuffle()
+            return
+
         import random
         random.shuffle(self.data['train'])
         random.shuffle(self.data['validation'])
         random.shuffle(self.data['test'])
-        if self.annotator_filter is not '':
-            self.data_mask = [x['annotator'] == self.annotator_filter for x in self.data[self.mode]]
+        self._update_data_index()
 
     def set_mode(self, mode):
-        if mode not in ['train', 'validation', 'test']:
+        if mode not in MODES:
             raise Exception('mode must be train or validation or test')
         self.mode = mode
-        if self.annotator_filter is not '':
-            self.data_mask = [x['annotator'] == self.annotator_filter for x in self.data[self.mode]]
+        self._update_data_index()
 
     def set_annotator_filter(self, annotator_filter):
         self.annotator_filter = annotator_filter
-        self.data_mask = [x['annotator'] == self.annotator_filter for x in self.data[self.mode]]
+        self._update_data_index()
 
     def no_annotator_filter(self):
         self.annotator_filter = ''
-        self.data_mask = None
+        self.data_index = None
+
+    def create_pseudo_labels(self, annotator, pseudo_annotator, model, batch_size=1024):
+        """
+        Label each data point labeled by annotator with pseudo labels by pseudo_annotator / the model.
+        All points that still need a label are run through the model in batches without autograd.
 
-    def create_pseudo_labels(self, annotator, pseudo_annotator, model):
-        # label each data point labeled by annotator with pseudo labels by pseduo_annotator / the model
+        Args:
+            annotator (str or list): annotator(s) whose data points get pseudo labels
+            pseudo_annotator (str): annotator the model was trained on
+            batch_size (int): number of samples per forward pass
+        """
+        points = self._points_without_pseudo_label(annotator, pseudo_annotator)
+
+        predictions = []
+        with torch.inference_mode():
+            for start in range(0, len(points), batch_size):
+                inp = torch.as_tensor(np.stack([self._embedding_of(point) for point in points[start:start + batch_size]]),
+                                      dtype=self.embedding_dtype).to(device=self.device)
+                predictions.append(model(inp).argmax(dim=1))
+
+        # single transfer of all predictions to the host
+        if len(predictions) != 0:
+            for point, pseudo_label in zip(points, torch.cat(predictions).tolist()):
+                point[self.pseudo_labels_key][pseudo_annotator] = pseudo_label
+
+        self.columns = None
+        self._update_data_index()
+
+    def _points_without_pseudo_label(self, annotator, pseudo_annotator):
+        annotators = annotator if isinstance(annotator, list) else [annotator]
+        points = []
         for mode in self.data.keys():
             for point in self.data[mode]:
-                if point[self.pseudo_labels_key] is None:
+                if point.get(self.pseudo_labels_key) is None:
                     point[self.pseudo_labels_key] = {}
-                if point['annotator'] is annotator and pseudo_annotator not in point[self.pseudo_labels_key].keys():
-                    inp = torch.tensor(point['embedding'], device=self.device, dtype=torch.float32)
-                    pseudo_label = model(inp).argmax().cpu().numpy().item()
-                    point[self.pseudo_labels_key][pseudo_annotator] = pseudo_label
+                if point['annotator'] in annotators and pseudo_annotator not in point[self.pseudo_labels_key].keys():
+                    points.append(point)
+        return points
 
-        if self.annotator_filter is not '':
-            self.data_mask = [x['annotator'] == self.annotator_filter for x in self.data[self.mode]]
+    def get_pseudo_label_map(self, pseudo_annotator):
+        """Map every text to its pseudo label by pseudo_annotator"""
+        pseudo_label_map = {}
+        for mode in self.data.keys():
+            for point in self.data[mode]:
+                pseudo_labels = point.get(self.pseudo_labels_key)
+                if pseudo_labels is not None and pseudo_annotator in pseudo_labels:
+                    pseudo_label_map[point['text']] = int(pseudo_labels[pseudo_annotator])
+        return pseudo_label_map
+
+    def use_pseudo_label_map(self, annotator, pseudo_annotator, pseudo_label_map):
+        """
+        Set the pseudo labels by pseudo_annotator of the data points labeled by annotator from a text map,
+        e.g. loaded from a cache. Returns the number of data points still without a pseudo label.
+        """
+        missing = 0
+        for point in self._points_without_pseudo_label(annotator, pseudo_annotator):
+            if point['text'] in pseudo_label_map:
+                point[self.pseudo_labels_key][pseudo_annotator] = pseudo_label_map[point['text']]
+            else:
+                missing += 1
+
+        self.columns = None
+        return missing
+
+    def split_signature(self):
+        """Hash of the text processor settings and the texts of every split, independent of the order of the data"""
+        settings = {key: self.argv.get(key) for key in ['text_processor', 'text_processor_filters', 'embedding_path',
+                                                         'domain_embedding_path', 'padding_length', 'embedding_dim']}
+        sha1 = hashlib.sha1(repr(sorted(settings.items())).encode())
+        for mode in MODES:
+            sha1.update(f'\0{mode}\0'.encode())
+            for text in sorted(set(str(point['text']) for point in self.data[mode])):
+                sha1.update(text.encode() + b'\0')
+        return sha1.hexdigest()
 
     def remove_pseudo_labels(self):
         for mode in self.data.keys():
             for point in self.data[mode]:
                 point[self.pseudo_labels_key] = {}
+        self.columns = None
 
     def use_custom_labels(self, sample_label_map, mode='train'):
         """Use custom labels and discard redundant training data
@@ -135,39 +294,238 @@ class BaseDataset(Dataset):
             sample_label_map (dict): map every sample text to its predicted label
         """
         self.set_mode(mode)
-        samples = list(sample_label_map.keys())
+        # keep the first point of every text in sample_label_map
+        used_texts = set()
         new_data = []
         for point in self.data[self.mode]:
-            if point['text'] in samples and point['text'] not in [new_point['text'] for new_point in new_data]:
+            if point['text'] in sample_label_map and point['text'] not in used_texts:
                 point['label'] = sample_label_map[point['text']]
                 point['annotator'] = 'custom'
+                used_texts.add(point['text'])
                 new_data.append(point)
         self.data[self.mode] = new_data
+        self.columns = None
+        self._update_data_index()
 
     def __len__(self):
-        if self.annotator_filter is not '':
-            return len([x for x in compress(self.data[self.mode], self.data_mask)])
+        if self._get_columns() is not None:
+            return len(self.columns.index(self.mode, self.annotator_filter))
+
+        if self.data_index is not None:
+            return len(self.data_index)
         else:
             return len(self.data[self.mode])
 
     def __getitem__(self, idx):
-        if self.annotator_filter is not '':
-            datapoint = [x for x in compress(self.data[self.mode], self.data_mask)][idx]
+        if self._get_columns() is not None:
+            position = self.columns.index(self.mode, self.annotator_filter)[idx]
+            return self.columns.get_item(position, self.device)
+
+        if self.data_index is not None:
+            return self.get_item(self.mode, self.data_index[idx], self.device)
         else:
-            datapoint = self.data[self.mode][idx]
+            return self.get_item(self.mode, idx, self.device)
+
+    def __getitems__(self, indices):
+        # fetch whole batches from the columnar storage, the collate function handles both formats
+        if self._get_columns() is not None:
+            positions = self.columns.index(self.mode, self.annotator_filter)[indices]
+            return self.columns.get_batch(positions)
+
+        return [self[idx] for idx in indices]
+
+    def positions(self, mode, annotator_filter=''):
+        """Positions of all samples in mode by annotator_filter ('' for all annotators), independent of the current mode"""
+        if self._get_columns() is not None:
+            return self.columns.index(mode, annotator_filter).copy()
+        if annotator_filter == '':
+            return np.arange(len(self.data[mode]), dtype=np.int64)
+        return np.asarray([idx for idx, x in enumerate(self.data[mode]) if x['annotator'] == annotator_filter],
+                          dtype=np.int64)
+
+    @property
+    def annotators(self):
+        return self._annotators
+
+    @annotators.setter
+    def annotators(self, annotators):
+        self._annotators = annotators
+        self._annotator_index = None
+
+    def annotator_index(self, annotator):
+        """
+        Index of annotator in annotators. Other annotators of the data (e.g. 'custom' or pseudo annotators)
+        get the indices from len(annotators) on, in the order they appear in the data. Indices never change
+        until annotators is assigned, so the record and the columnar storage share them.
+        """
+        if self._annotator_index is None or annotator not in self._annotator_index:
+            self._index_annotators()
+            if annotator not in self._annotator_index:
+                self._annotator_index[annotator] = len(self._annotator_index)
+        return self._annotator_index[annotator]
+
+    def _index_annotators(self):
+        """Append the annotators of the data without an index to the annotator index"""
+        if self._annotator_index is None:
+            self._annotator_index = {ann: idx for idx, ann in enumerate(self.annotators)}
+        if not isinstance(self.data, dict):
+            return
+        for mode in MODES:
+            for point in self.data.get(mode, []):
+                for ann in [point['annotator'], *self._pseudo_labels_of(point)]:
+                    if ann not in self._annotator_index:
+                        self._annotator_index[ann] = len(self._annotator_index)
+
+    def indexed_annotators(self):
+        """All annotators that have an index, ordered by it"""
+        if self._annotator_index is None:
+            self._index_annotators()
+        return list(self._annotator_index)
+
+    def annotator_ids(self, mode, annotator_filter=''):
+        """Annotator index of every sample in positions(mode, annotator_filter)"""
+        positions = self.positions(mode, annotator_filter)
+        if self._get_columns() is not None:
+            return self.columns.annotator_idx.numpy()[positions]
+        return np.asarray([self.annotator_index(self.data[mode][position]['annotator']) for position in positions],
+                          dtype=np.int64)
+
+    def get_item(self, mode, position, device=torch.device('cpu')):
+        """Sample at position of mode (see positions), independent of the current mode and annotator filter"""
+        if self._get_columns() is not None:
+            return self.columns.get_item(position, device)
+
+        datapoint = self.data[mode][position]
 
         # convert to torch tensor
         out = datapoint.copy()
-        out['embedding'] = torch.tensor(datapoint['embedding'], device=self.device, dtype=torch.float32)
-        out['label'] = torch.tensor(int(datapoint['label']), device=self.device, dtype=torch.long)
-        if datapoint['pseudo_labels'] is None:
-            out['pseudo_labels'] = {}
-        for pseudo_ann in out['pseudo_labels'].keys():
-            out['pseudo_labels'][pseudo_ann] = torch.tensor(int(datapoint['pseudo_labels'][pseudo_ann]), device=self.device, dtype=torch.long)
+        out['embedding'] = torch.tensor(self._embedding_of(datapoint), device=device, dtype=self.embedding_dtype)
+        out['label'] = torch.tensor(int(self._label_of(datapoint)), device=device, dtype=torch.long)
+        out['annotator_idx'] = torch.tensor(self.annotator_index(datapoint['annotator']), device=device, dtype=torch.long)
+        pseudo_labels = self._pseudo_labels_of(datapoint)
+        out[self.pseudo_labels_key] = pseudo_labels
+        out['pseudo_labels'] = {pseudo_ann: torch.tensor(int(pseudo_label), device=device, dtype=torch.long)
+                                for pseudo_ann, pseudo_label in pseudo_labels.items()}
 
         return out
 
 
+class DatasetView(Dataset):
+    """
+    Fixed view on the samples of one mode and annotator filter of a dataset. The positions are taken once,
+    so the view neither depends on nor changes the mode and filter of the dataset. Samples are built on the
+    cpu, so the view can be used by data loader workers.
+    """
+
+    def __init__(self, dataset, mode, annotator_filter=''):
+        self.dataset = dataset
+        self.mode = mode
+        self.annotator_filter = annotator_filter
+        self.positions = dataset.positions(mode, annotator_filter)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, idx):
+        return self.dataset.get_item(self.mode, self.positions[idx])
+
+    def __getitems__(self, indices):
+        if self.dataset.columns is not None:
+            return self.dataset.columns.get_batch(self.positions[indices])
+
+        return [self[idx] for idx in indices]
+
+
+class ColumnarStorage(object):
+    """
+    Contiguous, array-backed copy of the split data of a dataset.
+    The samples of all modes are stored one after another in every column, while modes and
+    annotator filters are index arrays into these columns. Texts are kept in a side table.
+    """
+
+    def __init__(self, dataset):
+        points = [point for mode in MODES for point in dataset.data[mode]]
+
+        # indices of the dataset, annotators that are not part of the dataset annotators (e.g. 'custom') come last
+        annotator_idx = [dataset.annotator_index(point['annotator']) for point in points]
+        pseudo_label_idx = [[(dataset.annotator_index(pseudo_ann), int(pseudo_label))
+                             for pseudo_ann, pseudo_label in dataset._pseudo_labels_of(point).items()]
+                            for point in points]
+        self.annotators = dataset.indexed_annotators()
+        self.annotator_map = {ann: idx for idx, ann in enumerate(self.annotators)}
+
+        self.texts = [point['text'] for point in points]
+        self.embedding = torch.as_tensor(np.stack([dataset._embedding_of(point) for point in points]),
+                                         dtype=dataset.embedding_dtype)
+        self.label = torch.tensor([int(dataset._label_of(point)) for point in points], dtype=torch.long)
+        self.annotator_idx = torch.tensor(annotator_idx, dtype=torch.long)
+
+        # pseudo labels of all annotators per sample, -1 if there is none
+        pseudo_labels = np.full((len(points), len(self.annotators)), -1, dtype=np.int64)
+        for i, sample_pseudo_labels in enumerate(pseudo_label_idx):
+            for ann_idx, pseudo_label in sample_pseudo_labels:
+                pseudo_labels[i, ann_idx] = pseudo_label
+        self.pseudo_labels = torch.from_numpy(pseudo_labels)
+        self.has_pseudo_labels = bool((pseudo_labels >= 0).any())
+
+        self.split = np.concatenate([np.full(len(dataset.data[mode]), code, dtype=np.int8)
+                                     for code, mode in enumerate(MODES)])
+        self.mode_index = {mode: np.flatnonzero(self.split == code) for code, mode in enumerate(MODES)}
+        self._index_cache = {}
+
+    def index(self, mode, annotator_filter=''):
+        """Positions of all samples in mode by annotator_filter ('' for all annotators)"""
+        key = (mode, annotator_filter)
+        if key not in self._index_cache:
+            index = self.mode_index[mode]
+            if annotator_filter != '':
+                annotator_idx = self.annotator_map.get(annotator_filter, -1)
+                index = index[self.annotator_idx.numpy()[index] == annotator_idx]
+            self._index_cache[key] = index
+        return self._index_cache[key]
+
+    def share_memory(self):
+        for column in [self.embedding, self.label, self.annotator_idx, self.pseudo_labels]:
+            column.share_memory_()
+        return self
+
+    def shuffle(self):
+        for mode in MODES:
+            self.mode_index[mode] = np.random.permutation(self.mode_index[mode])
+        self._index_cache = {}
+
+    def _pseudo_label_dicts(self, pseudo_labels):
+        if not self.has_pseudo_labels:
+            return [{} for _ in range(pseudo_labels.shape[0])]
+        return [{self.annotators[ann_idx]: label for ann_idx, label in enumerate(row) if label >= 0}
+                for row in pseudo_labels.tolist()]
+
+    def get_item(self, position, device=torch.device('cpu')):
+        annotator_idx = self.annotator_idx[position]
+        pseudo_labels = self._pseudo_label_dicts(self.pseudo_labels[position:position + 1])[0]
+        return {
+            'text': self.texts[position],
+            'annotator': self.annotators[annotator_idx],
+            'annotator_idx': annotator_idx.to(device=device),
+            'embedding': self.embedding[position].to(device=device),
+            'label': self.label[position].to(device=device),
+            'pseudo_labels': {pseudo_ann: torch.tensor(pseudo_label, device=device, dtype=torch.long)
+                              for pseudo_ann, pseudo_label in pseudo_labels.items()},
+        }
+
+    def get_batch(self, positions):
+        positions = torch.as_tensor(positions, dtype=torch.long)
+        annotator_idx = self.annotator_idx[positions]
+        return {
+            'text': [self.texts[position] for position in positions.tolist()],
+            'annotator': [self.annotators[ann_idx] for ann_idx in annotator_idx.tolist()],
+            'annotator_idx': annotator_idx,
+            'embedding': self.embedding[positions],
+            'label': self.label[positions],
+            'pseudo_labels': self._pseudo_label_dicts(self.pseudo_labels[positions]),
+        }
+
+
 class SimpleCustomBatch:
     """
     Create function to apply to batch to allow for memory pinning when using a custom batch/custom dataset.
@@ -175,6 +533,15 @@ class SimpleCustomBatch:
     """
 
     def __init__(self, data, device):
+        if isinstance(data, dict):
+            # whole batch fetched at once from a columnar storage
+            self.input = data['embedding'].to(device=device)
+            self.target = data['label'].to(device=device)
+            self.pseudo_targets = data['pseudo_labels']
+            self.annotations = data['annotator']
+            self.annotator_idx = data['annotator_idx'].to(device=device)
+            return
+
         self.input = torch.stack([sample['embedding'] for sample in data]).to(device=device)
         self.target = torch.stack([sample['label'] for sample in data]).to(device=device)
 
@@ -183,12 +550,20 @@ class SimpleCustomBatch:
         else:
             self.pseudo_targets = []
 
-        # record annotator information in list
+        # record annotator information in list and as indices into the annotators of the dataset
         self.annotations = ([sample['annotator'] for sample in data])
+        self.annotator_idx = torch.stack([sample['annotator_idx'] for sample in data]).to(device=device)
 
     def pin_memory(self):
         self.input = self.input.pin_memory()
         self.target = self.target.pin_memory()
+        self.annotator_idx = self.annotator_idx.pin_memory()
+        return self
+
+    def to(self, device, non_blocking=False):
+        self.input = self.input.to(device=device, non_blocking=non_blocking)
+        self.target = self.target.to(device=device, non_blocking=non_blocking)
+        self.annotator_idx = self.annotator_idx.to(device=device, non_blocking=non_blocking)
         return self
 
 
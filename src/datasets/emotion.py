@@ -1,9 +1,8 @@
-from datasets import BaseDataset
+from datasets import BaseDataset, split_by_text
+from collections import Counter
 from functools import reduce
-from itertools import compress
 
 import pandas as pd
-import torch
 
 
 def file_processor(path, text_processor):
@@ -92,6 +91,15 @@ class EmotionDataset(BaseDataset):
             raise Exception(f"Emotion must be one of these: \n{','.join(self.emotions)}")
         self.emotion = emotion
         self.pseudo_labels_key = f'{self.emotion}_pseudo_labels'
+        self.columns = None
+
+    def _label_of(self, point):
+        return point[f'{self.emotion}_label']
+
+    def _pseudo_labels_of(self, point):
+        if (self.pseudo_labels_key not in point) or point[self.pseudo_labels_key] is None:
+            return {}
+        return point[self.pseudo_labels_key]
 
     def custom_data_split(self):
         # since split isn't always the same for some reason, do it explicitly here
@@ -99,9 +107,9 @@ class EmotionDataset(BaseDataset):
         modes = ['train', 'validation', 'test']
         split_at = {'train': 72, 'validation': 18, 'test': 10}
         new_texts = {'train': [], 'validation': [], 'test': []}
-        annotator_texts = {}
-        for ann in self.annotators:
-            annotator_texts[ann] = [point['text'] for point in self.data if point['annotator'] == ann]
+        annotator_texts = {ann: [] for ann in self.annotators}
+        for point in self.data:
+            annotator_texts[point['annotator']].append(point['text'])
         problem_text = "Outcry at N Korea 'nuclear test'"
         for mode in modes:
             i = 0
@@ -118,31 +126,14 @@ class EmotionDataset(BaseDataset):
                             #     print(f'{annotator_texts[ann]}')
                 i = (i + 1) % len(self.annotators)
 
+        # every point is added once per occurrence of its text in the split
+        text_counts = {mode: Counter(new_texts[mode]) for mode in modes}
         new_data = {
-            mode: [point for point in self.data for text in new_texts[mode] if point['text'] == text]
+            mode: [point for point in self.data for _ in range(text_counts[mode][point['text']])]
             for mode in modes
         }
         self.data = new_data
 
-    def __getitem__(self, idx):
-        if self.annotator_filter is not '':
-            datapoint = [x for x in compress(self.data[self.mode], self.data_mask)][idx]
-        else:
-            datapoint = self.data[self.mode][idx]
-
-        # convert to torch tensor
-        out = datapoint.copy()
-        out['embedding'] = torch.tensor(datapoint['embedding'], device=self.device, dtype=torch.float32)
-        out['label'] = torch.tensor(int(datapoint[f'{self.emotion}_label']), device=self.device, dtype=torch.long)
-
-        if (self.pseudo_labels_key not in datapoint) or datapoint[self.pseudo_labels_key] is None:
-            out[self.pseudo_labels_key] = {}
-        out['pseudo_labels'] = {}
-        for pseudo_ann in out[self.pseudo_labels_key].keys():
-            out['pseudo_labels'][pseudo_ann] = torch.tensor(int(datapoint[self.pseudo_labels_key][pseudo_ann]), device=self.device, dtype=torch.long)
-
-        return out
-    
     def data_shuffle(self, split_included=False):
         import random
         random.seed(123456789)
@@ -157,16 +148,8 @@ class EmotionDataset(BaseDataset):
         length = 100
         eof_train_split = int(length * self.train_val_split * 0.9)
         eof_val_split = int(length * 0.9)
-        
-        train_filter = [(x['text'] in headlines[0:eof_train_split]) for x in self.data] 
-        valid_filter = [(x['text'] in headlines[eof_train_split:eof_val_split]) for x in self.data] 
-        test_filter  = [(x['text'] in headlines[eof_val_split:]) for x in self.data]
-
-        self.data = {
-            'train': [x for x in compress(self.data, train_filter)],
-            'validation': [x for x in compress(self.data, valid_filter)],
-            'test': [x for x in compress(self.data, test_filter)]
-        }
 
-        if self.annotator_filter is not '':
-            self.data_mask = [x['annotator'] == self.annotator_filter for x in self.data[self.mode]]
+        self.data = split_by_text(self.data, headlines, eof_train_split, eof_val_split)
+
+        self.columns = None
+        self._update_data_index()
@@ -0,0 +1,116 @@
+import torch
+import numpy as np
+from torch.utils.data import DataLoader, Sampler
+
+from . import DatasetView, collate_wrapper_cpu
+
+
+class AnnotatorBatchSampler(Sampler):
+    """
+    Batch sampler grouping samples by their annotator index (see BaseDataset.annotator_ids).
+    'homogeneous' batches only hold samples of a single annotator, 'stratified' batches hold the annotators
+    in the proportion of the whole data. Batches are reshuffled on every iteration if shuffle is set.
+    """
+
+    def __init__(self, annotator_ids, batch_size, strategy='homogeneous', shuffle=True, drop_last=False):
+        if strategy not in ['homogeneous', 'stratified']:
+            raise ValueError(f'Batch strategy {strategy} is not supported')
+        self.annotator_ids = np.asarray(annotator_ids)
+        self.batch_size = batch_size
+        self.strategy = strategy
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.annotator_indices = [np.flatnonzero(self.annotator_ids == ann_idx)
+                                  for ann_idx in np.unique(self.annotator_ids)]
+
+    def _split(self, indices):
+        batches = [indices[start:start + self.batch_size] for start in range(0, len(indices), self.batch_size)]
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        return batches
+
+    def _batches(self):
+        annotator_indices = [np.random.permutation(indices) if self.shuffle else indices
+                             for indices in self.annotator_indices]
+        if self.strategy == 'homogeneous':
+            batches = [batch for indices in annotator_indices for batch in self._split(indices)]
+            if self.shuffle:
+                batches = [batches[i] for i in np.random.permutation(len(batches))]
+            return batches
+
+        # interleave the annotators by the relative rank of each sample within its annotator
+        if len(annotator_indices) == 0:
+            return []
+        indices = np.concatenate(annotator_indices)
+        offsets = [np.random.rand(len(ann_indices)) if self.shuffle else 0.5 for ann_indices in annotator_indices]
+        ranks = np.concatenate([(np.arange(len(ann_indices)) + offset) / len(ann_indices)
+                                for ann_indices, offset in zip(annotator_indices, offsets)])
+        return self._split(indices[np.argsort(ranks, kind='stable')])
+
+    def __iter__(self):
+        for batch in self._batches():
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.strategy == 'homogeneous':
+            if self.drop_last:
+                return sum(len(indices) // self.batch_size for indices in self.annotator_indices)
+            return sum(-(-len(indices) // self.batch_size) for indices in self.annotator_indices)
+        if self.drop_last:
+            return len(self.annotator_ids) // self.batch_size
+        return -(-len(self.annotator_ids) // self.batch_size)
+
+
+class DeviceLoader(object):
+    """Iterates over a data loader and moves every batch to device in the main process"""
+
+    def __init__(self, loader, device, non_blocking=False):
+        self.loader = loader
+        self.device = device
+        self.non_blocking = non_blocking
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for batch in self.loader:
+            yield batch.to(self.device, non_blocking=self.non_blocking)
+
+
+class DataPipeline(object):
+    """
+    Data loaders of a dataset, built once per mode, annotator filter and shuffling and reused across epochs.
+    Shuffling is done by the sampler of the loader, so the data itself does not need to be reshuffled.
+    Batches are collated on the cpu (in worker processes if num_workers > 0) and moved to the device afterwards.
+    Shuffled loaders can group their batches by annotator (annotator_batches 'homogeneous' or 'stratified').
+    Call reset whenever the data changes (e.g. new pseudo labels or a new split).
+    """
+
+    def __init__(self, dataset, batch_size, device=torch.device('cpu'), num_workers=0, persistent_workers=False,
+                 prefetch_factor=2, pin_memory=False, annotator_batches=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = device
+        self.num_workers = num_workers
+        self.persistent_workers = persistent_workers and num_workers > 0
+        self.prefetch_factor = prefetch_factor if num_workers > 0 else None
+        self.pin_memory = pin_memory and device.type == 'cuda'
+        self.annotator_batches = annotator_batches
+        self._loaders = {}
+
+    def loader(self, mode, annotator_filter='', shuffle=False):
+        key = (mode, annotator_filter, shuffle)
+        if key not in self._loaders:
+            view = DatasetView(self.dataset, mode, annotator_filter)
+            loader_args = {'batch_size': self.batch_size, 'shuffle': shuffle}
+            if shuffle and self.annotator_batches is not None:
+                loader_args = {'batch_sampler': AnnotatorBatchSampler(self.dataset.annotator_ids(mode, annotator_filter),
+                                                                      self.batch_size, self.annotator_batches)}
+            loader = DataLoader(view, collate_fn=collate_wrapper_cpu, num_workers=self.num_workers,
+                                persistent_workers=self.persistent_workers, prefetch_factor=self.prefetch_factor,
+                                pin_memory=self.pin_memory, **loader_args)
+            self._loaders[key] = DeviceLoader(loader, self.device, non_blocking=self.pin_memory)
+        return self._loaders[key]
+
+    def reset(self):
+        self._loaders = {}
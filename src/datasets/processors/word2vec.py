@@ -1,8 +1,110 @@
+import os
+import tempfile
 import numpy as np
 from nltk.tokenize import RegexpTokenizer
 import pickle
 
 
+class MemoryMappedEmbeddings(object):
+    """
+    Read-only word to vector lookup backed by a memory-mapped float32 matrix.
+    Domain embeddings are kept in a small delta table that takes precedence over the matrix.
+    """
+
+    def __init__(self, matrix, vocabulary, delta=None):
+        self.matrix = matrix
+        self.vocabulary = vocabulary
+        self.delta = delta if delta is not None else {}
+
+    def __contains__(self, word):
+        return word in self.vocabulary
+
+    def __getitem__(self, word):
+        if word in self.delta:
+            return self.delta[word]
+        return self.matrix[self.vocabulary[word]]
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+    def keys(self):
+        return self.vocabulary.keys()
+
+    def __getstate__(self):
+        # worker processes map the matrix file again instead of receiving a copy
+        state = self.__dict__.copy()
+        if isinstance(self.matrix, np.memmap):
+            state['matrix'] = self.matrix.filename
+        return state
+
+    def __setstate__(self, state):
+        if isinstance(state['matrix'], str):
+            state['matrix'] = np.load(state['matrix'], mmap_mode='r')
+        self.__dict__.update(state)
+
+
+def get_binary_embedding_paths(embedding_path, binary_embedding_path=''):
+    """Paths of the matrix (.npy) and the vocabulary (.vocab) of the binary embedding store"""
+    if binary_embedding_path == '':
+        binary_embedding_path = os.path.splitext(embedding_path)[0]
+    return f'{binary_embedding_path}.npy', f'{binary_embedding_path}.vocab'
+
+
+def _write_atomic(path, write):
+    """
+    Call write with a binary file object of a unique temporary file next to path and rename it to path,
+    so concurrent workers never load a half written file nor write to the same temporary file
+    """
+    fd, temp_path = tempfile.mkstemp(prefix=f'{os.path.basename(path)}.', suffix='.tmp',
+                                     dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def convert_embeddings(embedding_path, binary_embedding_path=''):
+    """
+    One-time conversion of a glove text file into a float32 matrix (.npy) and a vocabulary
+    with one word per line (.vocab), the line number being the row in the matrix.
+    """
+    matrix_path, vocabulary_path = get_binary_embedding_paths(embedding_path, binary_embedding_path)
+
+    words, vectors = [], []
+    with open(embedding_path, 'r', encoding="utf8") as f:
+        for line in f:
+            values = line.split()
+            words.append(values[0])
+            vectors.append(np.asarray(values[1:], "float32"))
+
+    # the vocabulary is replaced first, so a reader that sees the new matrix also sees its vocabulary
+    _write_atomic(vocabulary_path, lambda f: f.write('\n'.join(words).encode('utf8')))
+    _write_atomic(matrix_path, lambda f: np.save(f, np.stack(vectors)))
+
+    return matrix_path, vocabulary_path
+
+
+def load_embeddings(embedding_path, binary_embedding_path='', domain_embeddings=None):
+    matrix_path, vocabulary_path = get_binary_embedding_paths(embedding_path, binary_embedding_path)
+    if not os.path.exists(matrix_path) or not os.path.exists(vocabulary_path):
+        convert_embeddings(embedding_path, binary_embedding_path)
+
+    matrix = np.load(matrix_path, mmap_mode='r')
+    with open(vocabulary_path, 'r', encoding="utf8") as f:
+        vocabulary = {word: idx for idx, word in enumerate(f.read().split('\n'))}
+
+    # domain embeddings only replace words that are part of the original embedding
+    delta = {}
+    if domain_embeddings is not None:
+        delta = {word: vector for word, vector in domain_embeddings.items() if word in vocabulary}
+
+    return MemoryMappedEmbeddings(matrix, vocabulary, delta)
+
+
 def _build_text_processor(**argv):
     lang = argv.get('lang', 'en')
     tokenizer = RegexpTokenizer(r'\w+')
@@ -11,22 +113,14 @@ def _build_text_processor(**argv):
 
     domain_embedding_path = argv.get('domain_embedding_path', '')
     domain_embeddings = {}
-    if domain_embedding_path is not '':
+    if domain_embedding_path != '':
         with open(domain_embedding_path, 'rb') as f:
             # object assumed to be pickled
             domain_embeddings = pickle.load(f)
 
     embedding_path = argv.get('embedding_path', '../data/embeddings/word2vec/glove.6B.50d.txt')
-    embeddings = {}
-    with open(embedding_path, 'r', encoding="utf8") as f:
-        for line in f:
-            values = line.split()
-            word = values[0]
-            if word in domain_embeddings.keys():
-                vector = domain_embeddings[word]
-            else:
-                vector = np.asarray(values[1:], "float32")
-            embeddings[word] = vector
+    binary_embedding_path = argv.get('binary_embedding_path', '')
+    embeddings = load_embeddings(embedding_path, binary_embedding_path, domain_embeddings)
     return embeddings, tokenizer, padding_length, embedding_dim
 
 
@@ -47,9 +141,34 @@ def text_processor(model, line, **argv):
 
     # pad vectors to padding_length
     try:
-        vectors = np.array(vectors + (padding_length - len(vectors)) * [embedding_dim * [0]])
+        vectors = np.array(vectors + (padding_length - len(vectors)) * [embedding_dim * [0]], dtype=np.float32)
     except TypeError as te:
         print(f'padding_length: {padding_length}, embedding_dim: {embedding_dim}\nVectors: {vectors}')
         import sys
         sys.exit()
     return vectors
+
+
+def token_processor(model, line, vocabulary, **argv):
+    """
+    Map a line to padded int32 token ids instead of word vectors.
+    Ids index into a vocabulary shared by the whole dataset, id 0 is reserved for padding.
+    """
+    embeddings, tokenizer, padding_length, embedding_dim = model
+
+    tokenized = [word for word in tokenizer.tokenize(line) if word in embeddings]
+
+    ids = np.zeros(padding_length, dtype=np.int32)
+    for i, word in enumerate(tokenized[:padding_length]):
+        ids[i] = vocabulary.setdefault(word, len(vocabulary) + 1)
+    return ids
+
+
+def build_embedding_matrix(model, vocabulary):
+    """Float32 matrix with the vectors of all words in vocabulary, row 0 is the padding vector"""
+    embeddings, tokenizer, padding_length, embedding_dim = model
+
+    matrix = np.zeros((len(vocabulary) + 1, embedding_dim), dtype=np.float32)
+    for word, idx in vocabulary.items():
+        matrix[idx] = embeddings[word]
+    return matrix
@@ -1,9 +1,7 @@
 from datasets import BaseDataset
 from functools import reduce
-from itertools import compress
 
 import pandas as pd
-import torch
 
 
 def file_processor(comments_path, annotations_path, demographics_path, task, group_by_gender, percentage, only_male_female, text_processor):
@@ -95,6 +93,11 @@ class WikipediaDataset(BaseDataset):
                                                   self.task, self.group_by_gender, self.percentage, self.only_male_female,
                                                   self.text_processor)
 
+        # map rev_id to the embedding of its comment once instead of filtering the comments per sample
+        self.comment_embeddings = {}
+        for rev_id, embedding in zip(self.comments['rev_id'], self.comments['embedding']):
+            self.comment_embeddings.setdefault(rev_id, embedding)
+
         self.annotators = self.data.annotator.unique().tolist()
         self.data = self.data.to_dict('records')
 
@@ -102,37 +105,6 @@ class WikipediaDataset(BaseDataset):
 
         self.pseudo_labels_key = 'pseudo_labels'
 
-    def __getitem__(self, idx):
-        if self.annotator_filter is not '':
-            datapoint = [x for x in compress(self.data[self.mode], self.data_mask)][idx]
-        else:
-            datapoint = self.data[self.mode][idx]
-
+    def _embedding_of(self, point):
         # get embedding by rev_id
-        embedding = self.comments[self.comments['rev_id'] == datapoint['rev_id']]['embedding'].iloc[0]
-
-        # convert to torch tensor
-        out = datapoint.copy()
-        out['embedding'] = torch.tensor(embedding, device=self.device, dtype=torch.float32)
-        out['label'] = torch.tensor(int(datapoint['label']), device=self.device, dtype=torch.long)
-        if datapoint['pseudo_labels'] is None:
-            out['pseudo_labels'] = {}
-        for pseudo_ann in out['pseudo_labels'].keys():
-            out['pseudo_labels'][pseudo_ann] = torch.tensor(int(datapoint['pseudo_labels'][pseudo_ann]), device=self.device, dtype=torch.long)
-
-        return out
-
-    def create_pseudo_labels(self, annotator, pseudo_annotator, model):
-        # label each data point labeled by annotator with pseudo labels by pseduo_annotator / the model
-        for mode in self.data.keys():
-            for point in self.data[mode]:
-                if point[self.pseudo_labels_key] is None:
-                    point[self.pseudo_labels_key] = {}
-                if point['annotator'] is annotator and pseudo_annotator not in point[self.pseudo_labels_key].keys():
-                    embedding = self.comments[self.comments['rev_id'] == point['rev_id']]['embedding'].iloc[0]
-                    inp = torch.tensor(embedding, device=self.device, dtype=torch.float32)
-                    pseudo_label = model(inp).argmax().cpu().numpy().item()
-                    point[self.pseudo_labels_key][pseudo_annotator] = pseudo_label
-
-        if self.annotator_filter is not '':
-            self.data_mask = [x['annotator'] == self.annotator_filter for x in self.data[self.mode]]
+        return self.comment_embeddings[point['rev_id']]
@@ -0,0 +1,128 @@
+import os
+import csv
+import json
+import numpy as np
+
+
+class CsvSink(object):
+    """Streams rows of per sample evaluation outputs into a csv file"""
+
+    def __init__(self, path, fields):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(fields)
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class JsonlSink(object):
+    """Streams rows of per sample evaluation outputs into a file with one json object per line"""
+
+    def __init__(self, path, fields):
+        self.file = open(path, 'w')
+        self.fields = fields
+
+    def write_rows(self, rows):
+        self.file.write(''.join(json.dumps(dict(zip(self.fields, row))) + '\n' for row in rows))
+
+    def close(self):
+        self.file.close()
+
+
+def get_sample_sink(path, fields):
+    extension = os.path.splitext(path)[1]
+    if extension == '.csv':
+        return CsvSink(path, fields)
+    elif extension in ['.jsonl', '.json']:
+        return JsonlSink(path, fields)
+    raise ValueError(f'No sample sink for files with extension {extension}, use .csv or .jsonl')
+
+
+def format_bias_matrices(summary, labels=None):
+    bias_conf_out = 'Annotation bias and confusion matrices\n\n'
+    for annotator in summary['annotators']:
+        bias_matrix = summary['bias_matrices'][annotator]
+        confusion_matrix = summary['confusion_matrices'][annotator]
+        bias_conf_out += f'Annotator {annotator}\n'
+        bias_conf_out += f'Output\\LatentTruth'
+        if labels is not None:
+            for label in labels:
+                bias_conf_out += '\t' * 3 + f'{label}'
+            bias_conf_out += '\t' * 5 + f'Label\\LatentTruth'
+            for label in labels:
+                bias_conf_out += '\t' * 3 + f'{label}'
+            bias_conf_out += '\n'
+            for j, label in enumerate(labels):
+                bias_conf_out += f'{label}' + ' ' * (15 - len(label))
+                for k, label_2 in enumerate(labels):
+                    bias_conf_out += '\t' * 3 + f'{bias_matrix[j][k]: .4f}'
+                bias_conf_out += '\t' * 5
+                bias_conf_out += f'{label}' + ' ' * (15 - len(label))
+                for k, label_2 in enumerate(labels):
+                    bias_conf_out += '\t' * 3 + f'{confusion_matrix[j][k]: .4f}'
+                bias_conf_out += '\n'
+            bias_conf_out += '\n'
+        else:
+            bias_conf_out += f'{bias_matrix}\n\n'
+    return bias_conf_out
+
+
+def format_evaluation_report(summary, labels=None):
+    """Human readable report of the summary returned by Solver.evaluate_model"""
+    annotators = summary['annotators']
+
+    # Document overall accuracy
+    overall_correct, overall_len = summary['overall_correct'], summary['overall_len']
+    overall_acc_out = 'Overall accuracies\n\n'
+    overall_acc_out += f'Accuracy after extensive training'
+    if not summary['basic_only']:
+        overall_acc_out += ' with bias matrices'
+    overall_acc_out += f': {overall_correct} / {overall_len} or as percentage: {overall_correct / overall_len:.5f}\n'
+    if summary['pretrained_correct'] is not None:
+        pretrained_correct = summary['pretrained_correct']
+        overall_acc_out += f'Accuracy with pretrained model: {pretrained_correct} / {overall_len} ' + \
+            f'or as percentage: {pretrained_correct / overall_len:.5f}\n\n'
+    else:
+        overall_acc_out += '\n\n'
+    out = [overall_acc_out]
+
+    if not summary['basic_only']:
+        # Document Loss
+        loss_out = f'Mean Loss (over annotators & samples): {summary["mean_loss"]:.5f}\n'
+        loss_out += f'Mean Loss for each annotator (over samples):\n'
+        for ann in annotators:
+            loss_out += f'Annotator {ann}: {summary["mean_losses"][ann]:.5f}        '
+        loss_out += '\n\n\n'
+        out.append(loss_out)
+
+        out.append(format_bias_matrices(summary, labels))
+
+        # Document correct predictions
+        acc_out = ''
+        for annotator in annotators:
+            samples = summary['samples'][annotator]
+            different_answers_idx = summary['different_answers_idx'][annotator]
+            acc_out += '-' * 25 + f'   Annotator {annotator}   ' + '-' * 25 + '\n'
+            acc_out += f'Different answers given by bias matrices {summary["different_answers"][annotator]} / {samples} times\n'
+            acc_out += f'Different answers at points: {different_answers_idx[:min(5, len(different_answers_idx))]}\n'
+            acc_out += f'Accuracies of samples labeled by {annotator}:'
+            acc_out += '\n'
+            for ann in annotators:
+                acc_out += f'Annotator {ann}: {summary["correct"][annotator][ann]} / {samples}     '
+            acc_out += '\n\n'
+        out.append(acc_out)
+
+        if summary.get('samples_path') is not None:
+            out.append(f'Outputs for each sample: {summary["samples_path"]}\n')
+
+    return '\n'.join(out) + '\n'
+
+
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float64)
+    row_sums = matrix.sum(axis=1, keepdims=True)
+    return np.divide(matrix, row_sums, out=np.zeros_like(matrix), where=row_sums != 0.0)
@@ -0,0 +1,134 @@
+import os
+import struct
+import tempfile
+import numpy as np
+from tensorboard.compat.proto import event_pb2
+
+# TFRecord framing: uint64 length, uint32 masked crc of the length, data, uint32 masked crc of the data
+HEADER_SIZE = 12
+FOOTER_SIZE = 4
+
+
+def read_records(path, offset=0):
+    """
+    Yield (record, end offset) of all complete records of a TFRecord file starting at offset, without TensorFlow.
+    A record that is still being written is not yielded, reading can resume from the last end offset.
+    Checksums are not verified.
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            header = f.read(HEADER_SIZE)
+            if len(header) < HEADER_SIZE:
+                return
+            length = struct.unpack('<Q', header[:8])[0]
+            data = f.read(length + FOOTER_SIZE)
+            if len(data) < length + FOOTER_SIZE:
+                return
+            offset += HEADER_SIZE + length + FOOTER_SIZE
+            yield data[:length], offset
+
+
+def summary_iterator(path):
+    """Yield all events of an event file like TensorFlow's summary_iterator"""
+    for record, _ in read_records(path):
+        yield event_pb2.Event.FromString(record)
+
+
+def _scalar_value(value):
+    kind = value.WhichOneof('value')
+    if kind == 'simple_value':
+        return value.simple_value
+    if kind == 'tensor' and value.metadata.plugin_data.plugin_name == 'scalars':
+        from tensorboard.util import tensor_util
+        return float(tensor_util.make_ndarray(value.tensor))
+    return None
+
+
+def read_scalars(path, offset=0, tags=None):
+    """
+    Scalars of an event file from offset on as columns (steps, wall_times, tags, values) and the offset after the
+    last complete record. tags is a list that new tags are appended to, the tag column holds indices into it.
+    """
+    tags = [] if tags is None else tags
+    tag_index = {tag: idx for idx, tag in enumerate(tags)}
+    steps, wall_times, tag_idx, values = [], [], [], []
+    for record, offset in read_records(path, offset):
+        event = event_pb2.Event.FromString(record)
+        for value in event.summary.value:
+            scalar = _scalar_value(value)
+            if scalar is None:
+                continue
+            if value.tag not in tag_index:
+                tag_index[value.tag] = len(tags)
+                tags.append(value.tag)
+            steps.append(event.step)
+            wall_times.append(event.wall_time)
+            tag_idx.append(tag_index[value.tag])
+            values.append(scalar)
+    columns = {
+        'steps': np.array(steps, dtype=np.int64),
+        'wall_times': np.array(wall_times, dtype=np.float64),
+        'tag_idx': np.array(tag_idx, dtype=np.int64),
+        'values': np.array(values, dtype=np.float64),
+    }
+    return columns, tags, offset
+
+
+def get_scalar_cache_path(path):
+    """
+    Default cache of the scalars of an event file: in a .scalar_cache directory next to it, named without
+    'tfevents', so TensorBoard does not take caches for event files
+    """
+    directory, file_name = os.path.split(path)
+    return os.path.join(directory, '.scalar_cache', file_name.replace('tfevents', 'scalars') + '.npz')
+
+
+def load_scalars(path, cache_path=None):
+    """
+    Scalars of an event file as columns (steps, wall_times, tag_idx, values) plus the list of tags.
+    The columns are cached in an npz file (default: get_scalar_cache_path) together with the offset read up to,
+    later calls only parse the bytes appended since. A cache of a file that has shrunk is rebuilt.
+    """
+    if cache_path is None:
+        cache_path = get_scalar_cache_path(path)
+    size = os.path.getsize(path)
+
+    offset, tags, columns = 0, [], None
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cache:
+            if int(cache['offset']) <= size:
+                offset, tags = int(cache['offset']), cache['tags'].tolist()
+                columns = {key: cache[key] for key in ['steps', 'wall_times', 'tag_idx', 'values']}
+
+    if columns is None or offset < size:
+        new_columns, tags, new_offset = read_scalars(path, offset, tags)
+        if columns is not None:
+            new_columns = {key: np.concatenate([columns[key], new_columns[key]]) for key in new_columns}
+        columns = new_columns
+        if new_offset != offset or not os.path.exists(cache_path):
+            # write to a temporary file of this reader first, so a concurrent reader never loads a half written cache
+            cache_directory = os.path.dirname(cache_path) or '.'
+            os.makedirs(cache_directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(prefix=f'{os.path.basename(cache_path)}.', suffix='.tmp',
+                                             dir=cache_directory)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.savez(f, offset=new_offset, tags=np.array(tags, dtype=str), **columns)
+                os.replace(temp_path, cache_path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+
+    columns['tags'] = tags
+    return columns
+
+
+def scalar_events(path, cache_path=None):
+    """Yield (step, tag, value) of all scalars of an event file in the order they were written"""
+    columns = load_scalars(path, cache_path)
+    tags = columns['tags']
+    for step, tag_idx, value in zip(columns['steps'].tolist(), columns['tag_idx'].tolist(),
+                                    columns['values'].tolist()):
+        yield step, tags[tag_idx], value
@@ -0,0 +1,111 @@
+import os
+import csv
+from abc import ABC, abstractmethod
+
+
+class MetricsSink(ABC):
+    """
+    Collects scalars (tag, value, step) in memory and writes them to a backend every flush_every steps
+    (None: only on flush and close), buffered steps are written once the first value of a further step arrives.
+    Values logged more than once for a tag and step are averaged.
+    Values may be tensors, they are only converted to floats when flushing.
+    """
+
+    def __init__(self, flush_every=1):
+        self.flush_every = flush_every
+        self.buffer = {}
+        self.steps = set()
+
+    def add_scalar(self, tag, value, step):
+        if self.flush_every is not None and step not in self.steps and len(self.steps) >= self.flush_every:
+            self.flush()
+        key = (tag, step)
+        total, count = self.buffer.get(key, (0.0, 0))
+        self.buffer[key] = (total + value, count + 1)
+        self.steps.add(step)
+
+    def flush(self):
+        rows = [(step, tag, float(total) / count) for (tag, step), (total, count) in self.buffer.items()]
+        self.buffer = {}
+        self.steps = set()
+        if len(rows) > 0:
+            self._write(sorted(rows, key=lambda row: row[0]))
+
+    @abstractmethod
+    def _write(self, rows):
+        """Write rows (step, tag, value) to the backend"""
+
+    def close(self):
+        self.flush()
+
+
+class NullMetricsSink(MetricsSink):
+    """Drops all metrics"""
+
+    def __init__(self):
+        super().__init__(flush_every=None)
+
+    def add_scalar(self, tag, value, step):
+        pass
+
+    def _write(self, rows):
+        pass
+
+
+class TensorBoardMetricsSink(MetricsSink):
+    def __init__(self, writer, flush_every=1):
+        super().__init__(flush_every=flush_every)
+        self.writer = writer
+
+    def _write(self, rows):
+        for step, tag, value in rows:
+            self.writer.add_scalar(tag, value, step)
+        self.writer.flush()
+
+    def close(self):
+        super().close()
+        self.writer.close()
+
+
+class CsvMetricsSink(MetricsSink):
+    """Appends rows step, tag, value to a csv file"""
+
+    def __init__(self, path, flush_every=10):
+        super().__init__(flush_every=flush_every)
+        self.path = path
+
+    def _write(self, rows):
+        new_file = not os.path.exists(self.path)
+        with open(self.path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(['step', 'tag', 'value'])
+            writer.writerows(rows)
+
+
+class ParquetMetricsSink(MetricsSink):
+    """Keeps all rows and rewrites a parquet file on every flush (parquet files can not be appended to)"""
+
+    def __init__(self, path, flush_every=None):
+        super().__init__(flush_every=flush_every)
+        self.path = path
+        self.rows = []
+
+    def _write(self, rows):
+        import pandas as pd
+        self.rows.extend(rows)
+        pd.DataFrame(self.rows, columns=['step', 'tag', 'value']).to_parquet(self.path, index=False)
+
+
+def get_metrics_sink(writer=None, path=None, flush_every=1):
+    """TensorBoard sink for a writer, csv or parquet sink for a path (by extension), null sink otherwise"""
+    if writer is not None:
+        return TensorBoardMetricsSink(writer, flush_every=flush_every)
+    if path is not None:
+        extension = os.path.splitext(path)[1]
+        if extension == '.csv':
+            return CsvMetricsSink(path, flush_every=flush_every)
+        elif extension == '.parquet':
+            return ParquetMetricsSink(path, flush_every=flush_every)
+        raise ValueError(f'No metrics sink for files with extension {extension}, use .csv or .parquet')
+    return NullMetricsSink()
@@ -0,0 +1,77 @@
+import torch
+
+
+class StreamingConfusionMatrix:
+    """
+    Confusion matrices [annotator_dim, label_dim, label_dim] (rows: labels, columns: predictions) and loss sums
+    accumulated on the device of the model. Updates never synchronize with the host, the metrics are derived
+    once, e.g. at the end of an epoch, and equal sklearn's metrics over all samples seen.
+    """
+
+    def __init__(self, annotator_dim, label_dim, device=torch.device('cpu')):
+        self.annotator_dim = annotator_dim
+        self.label_dim = label_dim
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.matrix = torch.zeros(self.annotator_dim, self.label_dim, self.label_dim,
+                                  dtype=torch.long, device=self.device)
+        self.loss_sum = torch.zeros(self.annotator_dim, device=self.device)
+
+    def update(self, predictions, labels, annotator_idx=None):
+        """annotator_idx is either None (annotator 0), an int or a tensor with the annotator of every sample"""
+        if annotator_idx is None:
+            annotator_idx = 0
+        if isinstance(annotator_idx, int):
+            offset = annotator_idx * self.label_dim * self.label_dim
+        else:
+            offset = annotator_idx.to(self.device) * self.label_dim * self.label_dim
+        index = offset + labels.to(self.device) * self.label_dim + predictions.to(self.device)
+        self.matrix += torch.bincount(index.flatten(), minlength=self.matrix.numel()).view_as(self.matrix)
+
+    def update_loss(self, loss, samples, annotator_idx=0):
+        """
+        Add a mean loss over samples, either for one annotator or with loss and samples being
+        tensors [annotator_dim] for all annotators at once
+        """
+        if isinstance(samples, torch.Tensor):
+            self.loss_sum += loss.detach() * samples
+        else:
+            self.loss_sum[annotator_idx] += loss.detach() * samples
+
+    def samples(self):
+        return self.matrix.sum(dim=(1, 2))
+
+    def mean_loss(self):
+        return self.loss_sum / self.samples().clamp(min=1)
+
+    def measures(self, averaging_method='macro'):
+        """
+        Accuracy, precision, recall and f1 score [annotator_dim] computed from the confusion matrices.
+        Macro averaging only considers labels appearing in the labels or predictions (like sklearn),
+        zero divisions count as 0.
+        """
+        matrix = self.matrix.double()
+        true_positives = matrix.diagonal(dim1=-2, dim2=-1)
+        label_counts = matrix.sum(dim=-1)
+        prediction_counts = matrix.sum(dim=-2)
+        samples = label_counts.sum(dim=-1)
+
+        accuracy = true_positives.sum(dim=-1) / samples.clamp(min=1)
+        if averaging_method == 'micro':
+            # every sample has exactly one label and one prediction
+            return accuracy, accuracy, accuracy, accuracy
+
+        precision = true_positives / prediction_counts.clamp(min=1)
+        recall = true_positives / label_counts.clamp(min=1)
+        f1 = 2 * precision * recall / (precision + recall).clamp(min=1e-12)
+        if averaging_method == 'macro':
+            weights = ((label_counts + prediction_counts) > 0).double()
+        elif averaging_method == 'weighted':
+            weights = label_counts
+        else:
+            raise ValueError(f'Averaging method {averaging_method} is not supported')
+        weights = weights / weights.sum(dim=-1, keepdim=True).clamp(min=1e-12)
+
+        return accuracy, (precision * weights).sum(dim=-1), (recall * weights).sum(dim=-1), (f1 * weights).sum(dim=-1)
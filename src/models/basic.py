@@ -1,13 +1,19 @@
 from .utils import initialize_weight
 
 import torch.nn as nn
+import torch.nn.functional as F
 import torch
 
 
 class BasicNetwork(nn.Module):
-    def __init__(self, embedding_dim, label_dim, use_softmax=True, apply_log=False):
+    def __init__(self, embedding_dim, label_dim, use_softmax=True, apply_log=False, embedding_matrix=None):
         super().__init__()
 
+        # with an embedding matrix, inputs may be token ids that are looked up here (not saved in the state dict)
+        if embedding_matrix is not None:
+            embedding_matrix = torch.as_tensor(embedding_matrix, dtype=torch.float32)
+        self.register_buffer('embedding_matrix', embedding_matrix, persistent=False)
+
         self.attention = nn.Linear(embedding_dim, 1, bias=False)
         self.classifier = nn.Linear(embedding_dim, label_dim)
         self.softmax_batch = nn.Softmax(dim=1)
@@ -21,6 +27,9 @@ class BasicNetwork(nn.Module):
 
     def forward(self, x):
 
+        if self.embedding_matrix is not None and not x.is_floating_point():
+            x = F.embedding(x, self.embedding_matrix)
+
         shape_len = len(x.shape)
 
         # sum up word vectors weighted by their word-wise attentions
@@ -1,10 +1,6 @@
 """
 Copyright (C) 2014 Dallas Card
 Copyright (C) 2018 Vaibhav B Sinha, Sukrut Rao, Vineeth N Balasubramanian
-<<<<<<< Updated upstream
-
-=======
->>>>>>> Stashed changes
 Permission is hereby granted, free of charge, to any person obtaining a copy of this
 software and associated documentation files (the "Software"), to deal in the Software
 without restriction, including without limitation the rights to use, copy, modify, merge,
@@ -23,6 +19,7 @@ DEALINGS IN THE SOFTWARE.
 from __future__ import print_function
 
 import numpy as np
+from scipy.special import logsumexp
 
 
 def main(args, data, gold=None):
@@ -68,6 +65,8 @@ def run(responses, args, tol=0.0001, CM_tol=0.005, max_iter=100):
             'H': use for Hybrid algorithm
             'MV': use for Majority Voting
             And should contain verbose whose value should be either True or False
+            May contain sparse, if True the counts are kept as SparseCounts (memory scales with the
+            number of responses instead of questions x participants x classes)
         tol: threshold for class marginals for convergence of the algorithm
         CM_tol: threshold for class marginals for switching to 'hard' mode
             in Hybrid algorithm. Has no effect for FDS or DS
@@ -80,7 +79,10 @@ def run(responses, args, tol=0.0001, CM_tol=0.005, max_iter=100):
     mode = args['algorithm']
 
     # convert responses to counts
-    (questions, participants, classes, counts) = responses_to_counts(responses)
+    if args.get('sparse', False):
+        (questions, participants, classes, counts) = responses_to_sparse_counts(responses)
+    else:
+        (questions, participants, classes, counts) = responses_to_counts(responses)
     if args['verbose']:
         print("Number of Questions:", len(questions))
         print("Number of Participants:", len(participants))
@@ -151,6 +153,53 @@ def run(responses, args, tol=0.0001, CM_tol=0.005, max_iter=100):
     return result
 
 
+class SparseCounts(object):
+    """
+    Sparse (COO) counts of the responses: one entry per (question, participant, class) that was answered
+    at least once. Has the shape of the dense counts [questions x participants x classes].
+    """
+
+    def __init__(self, question_idx, participant_idx, class_idx, count, shape):
+        self.question_idx = np.asarray(question_idx, dtype=np.int64)
+        self.participant_idx = np.asarray(participant_idx, dtype=np.int64)
+        self.class_idx = np.asarray(class_idx, dtype=np.int64)
+        self.count = np.asarray(count, dtype=float)
+        self.shape = tuple(shape)
+
+    def toarray(self):
+        counts = np.zeros(self.shape)
+        np.add.at(counts, (self.question_idx, self.participant_idx, self.class_idx), self.count)
+        return counts
+
+
+def _index_responses(responses):
+    """Sorted questions, participants and classes and the (question, participant, class) index of every response"""
+    questions = sorted(responses.keys())
+
+    # determine the participants and classes
+    participants = set()
+    classes = set()
+    for i in questions:
+        for k, ik_responses in responses[i].items():
+            participants.add(k)
+            classes.update(ik_responses)
+
+    classes = sorted(classes)
+    participants = sorted(participants)
+
+    question_map = {question: i for i, question in enumerate(questions)}
+    participant_map = {participant: k for k, participant in enumerate(participants)}
+    class_map = {response: j for j, response in enumerate(classes)}
+
+    indices = [(question_map[question], participant_map[participant], class_map[response])
+               for question in questions
+               for participant, ik_responses in responses[question].items()
+               for response in ik_responses]
+    indices = np.array(indices, dtype=np.int64).reshape(-1, 3)
+
+    return questions, participants, classes, indices
+
+
 def responses_to_counts(responses):
     """
     Convert a matrix of annotations to count data
@@ -164,40 +213,35 @@ def responses_to_counts(responses):
         classes: list of possible classes (choices)
         counts: 3d array of counts: [questions x participants x classes]
     """
-    questions = responses.keys()
-    questions = sorted(questions)
-    nQuestions = len(questions)
+    questions, participants, classes, indices = _index_responses(responses)
 
-    # determine the participants and classes
-    participants = set()
-    classes = set()
-    for i in questions:
-        i_participants = responses[i].keys()
-        for k in i_participants:
-            if k not in participants:
-                participants.add(k)
-            ik_responses = responses[i][k]
-            classes.update(ik_responses)
+    # create a 3d array to hold counts
+    counts = np.zeros([len(questions), len(participants), len(classes)])
+    np.add.at(counts, (indices[:, 0], indices[:, 1], indices[:, 2]), 1)
 
-    classes = list(classes)
-    classes.sort()
-    nClasses = len(classes)
+    return (questions, participants, classes, counts)
 
-    participants = list(participants)
-    participants.sort()
-    nParticipants = len(participants)
 
-    # create a 3d array to hold counts
-    counts = np.zeros([nQuestions, nParticipants, nClasses])
+def responses_to_sparse_counts(responses):
+    """
+    Convert a matrix of annotations to sparse count data
 
-    # convert responses to counts
-    for question in questions:
-        i = questions.index(question)
-        for participant in responses[question].keys():
-            k = participants.index(participant)
-            for response in responses[question][participant]:
-                j = classes.index(response)
-                counts[i, k, j] += 1
+    Args:
+        responses: dictionary of responses {questions:{participants:[responses]}}
+
+    Returns:
+        questions: list of questions
+        participants: list of participants
+        classes: list of possible classes (choices)
+        counts: SparseCounts of shape [questions x participants x classes]
+    """
+    questions, participants, classes, indices = _index_responses(responses)
+
+    # merge repeated responses of a participant to a question
+    entries, count = np.unique(indices, axis=0, return_counts=True)
+    entries = entries.reshape(-1, 3)
+    counts = SparseCounts(entries[:, 0], entries[:, 1], entries[:, 2], count,
+                          [len(questions), len(participants), len(classes)])
 
     return (questions, participants, classes, counts)
 
@@ -207,7 +251,7 @@ def initialize(counts, mode):
     Get majority voting estimates for the true classes using counts
     Args:
         counts: counts of the number of times each response was received 
-            by each question from each participant: [questions x participants x classes]
+            by each question from each participant: [questions x participants x classes] or SparseCounts
         mode: One among ['FDS', 'DS', 'H', 'MV']
             'FDS', 'MV' and 'H' will give a majority voting initialization
             'DS' will give the initialization mentioned in Dawid and Skene (1979)
@@ -219,21 +263,32 @@ def initialize(counts, mode):
             [questions x responses] 
     """
     [nQuestions, nParticipants, nClasses] = np.shape(counts)
-    response_sums = np.sum(counts, 1)
-    question_classes = np.zeros([nQuestions, nClasses])
+    if isinstance(counts, SparseCounts):
+        response_sums = np.zeros([nQuestions, nClasses])
+        np.add.at(response_sums, (counts.question_idx, counts.class_idx), counts.count)
+    else:
+        response_sums = np.sum(counts, 1)
     if mode == 'FDS' or mode == 'MV':
-        for p in range(nQuestions):
-            indices = np.argwhere(response_sums[p, :] == np.max(
-                response_sums[p, :])).flatten()
-            question_classes[p, np.random.choice(indices)] = 1
+        question_classes = random_argmax_one_hot(response_sums)
     else:
-        for p in range(nQuestions):
-            question_classes[p, :] = response_sums[p, :] / \
-                np.sum(response_sums[p, :], dtype=float)
+        question_classes = response_sums / np.sum(response_sums, 1, keepdims=True, dtype=float)
 
     return question_classes
 
 
+def random_argmax_one_hot(scores):
+    """One hot matrix of the maximum of each row of scores, ties are broken uniformly at random"""
+    is_max = scores == np.max(scores, 1, keepdims=True)
+    choice = np.argmax(is_max, 1)
+    # only ties draw, row by row in the same order as the per question np.random.choice before, so seeded runs
+    # give the same classes (np.random.choice does not draw for a single index)
+    for row in np.flatnonzero(np.sum(is_max, 1) > 1):
+        choice[row] = np.random.choice(np.flatnonzero(is_max[row]))
+    one_hot = np.zeros(np.shape(scores))
+    one_hot[np.arange(len(choice)), choice] = 1
+    return one_hot
+
+
 def m_step(counts, question_classes):
     """
     M Step for the EM algorithm
@@ -244,7 +299,7 @@ def m_step(counts, question_classes):
     Classification)
     Args: 
         counts: Array of how many times each response was received
-            by each question from each participant: [questions x participants x classes]
+            by each question from each participant: [questions x participants x classes] or SparseCounts
         question_classes: Matrix of current assignments of questions to classes
     Returns:
         p_j: class marginals - the probability that the correct answer of a question
@@ -259,16 +314,14 @@ def m_step(counts, question_classes):
     class_marginals = np.sum(question_classes, 0) / float(nQuestions)
 
     # compute error rates
-    error_rates = np.zeros([nParticipants, nClasses, nClasses])
-    for k in range(nParticipants):
-        for j in range(nClasses):
-            for l in range(nClasses):
-                error_rates[k, j, l] = np.dot(
-                    question_classes[:, j], counts[:, k, l])
-            sum_over_responses = np.sum(error_rates[k, j, :])
-            if sum_over_responses > 0:
-                error_rates[k, j, :] = error_rates[
-                    k, j, :] / float(sum_over_responses)
+    if isinstance(counts, SparseCounts):
+        error_rates = np.zeros([nParticipants, nClasses, nClasses])
+        np.add.at(error_rates, (counts.participant_idx, slice(None), counts.class_idx),
+                  counts.count[:, None] * question_classes[counts.question_idx])
+    else:
+        error_rates = np.einsum('ij,ikl->kjl', question_classes, counts)
+    sum_over_responses = np.sum(error_rates, 2, keepdims=True)
+    error_rates = np.divide(error_rates, sum_over_responses, out=error_rates, where=sum_over_responses > 0)
 
     return (class_marginals, error_rates)
 
@@ -284,7 +337,7 @@ def e_step(counts, class_marginals, error_rates, mode):
     Classification)
     Args:
         counts: Array of how many times each response was received
-            by each question from each participant: [questions x participants x classes]
+            by each question from each participant: [questions x participants x classes] or SparseCounts
         class_marginals: probability of a random question belonging to each class: [classes]
         error_rates: probability of participant k assigning a question whose correct 
             label is j the label l: [participants x classes x classes]
@@ -299,32 +352,38 @@ def e_step(counts, class_marginals, error_rates, mode):
             [questions x classes]
     """
 
-    [nQuestions, nParticipants, nClasses] = np.shape(counts)
-
-    question_classes = np.zeros([nQuestions, nClasses])
-    final_classes = np.zeros([nQuestions, nClasses])
-
-    for i in range(nQuestions):
-        for j in range(nClasses):
-            estimate = class_marginals[j]
-            estimate *= np.prod(np.power(error_rates[:,
-                                                     j, :], counts[i, :, :]))
-
-            question_classes[i, j] = estimate
-        if mode == 'H' or mode == 'DS':
-            question_sum = np.sum(question_classes[i, :])
-            if question_sum > 0:
-                question_classes[i, :] = question_classes[
-                    i, :] / float(question_sum)
-        else:
-            indices = np.argwhere(question_classes[i, :] == np.max(
-                question_classes[i, :])).flatten()
-            final_classes[i, np.random.choice(indices)] = 1
+    log_question_classes = log_class_estimates(counts, class_marginals, error_rates)
 
     if mode == 'H' or mode == 'DS':
-        return question_classes
+        # normalize in log space, questions with no possible class keep all zeros
+        log_question_sums = logsumexp(log_question_classes, 1, keepdims=True)
+        finite = np.isfinite(log_question_sums)
+        return np.where(finite, np.exp(log_question_classes - np.where(finite, log_question_sums, 0.0)), 0.0)
+    else:
+        return random_argmax_one_hot(log_question_classes)
+
+
+def log_class_estimates(counts, class_marginals, error_rates):
+    """
+    Unnormalized log probability of each question belonging to each class: [questions x classes]
+    log p_j + sum_k sum_l counts_ikl * log pi_kjl, with 0 * log 0 = 0 like np.power(0, 0) = 1
+    """
+    with np.errstate(divide='ignore'):
+        log_class_marginals = np.log(class_marginals)
+    log_error_rates = np.log(np.where(error_rates > 0, error_rates, 1.0))
+
+    # responses a participant never gives for a class make that class impossible
+    if isinstance(counts, SparseCounts):
+        log_estimates = np.tile(log_class_marginals, (np.shape(counts)[0], 1))
+        rates = (counts.participant_idx, slice(None), counts.class_idx)
+        np.add.at(log_estimates, counts.question_idx, counts.count[:, None] * log_error_rates[rates])
+        impossible = np.zeros(np.shape(log_estimates), dtype=bool)
+        np.logical_or.at(impossible, counts.question_idx, error_rates[rates] <= 0)
     else:
-        return final_classes
+        log_estimates = log_class_marginals + np.einsum('ikl,kjl->ij', counts, log_error_rates)
+        impossible = np.einsum('ikl,kjl->ij', (counts > 0).astype(float), (error_rates <= 0).astype(float)) > 0
+    log_estimates[impossible] = -np.inf
+    return log_estimates
 
 
 def calc_likelihood(counts, class_marginals, error_rates):
@@ -337,7 +396,7 @@ def calc_likelihood(counts, class_marginals, error_rates):
 
     Args:
         counts: Array of how many times each response was received
-            by each question from each participant: [questions x participants x classes]
+            by each question from each participant: [questions x participants x classes] or SparseCounts
         class_marginals: probability of a random question belonging to each class: [classes]
         error_rates: probability of participant k assigning a question whose correct 
             label is j the label l: [observers x classes x classes]
@@ -345,27 +404,8 @@ def calc_likelihood(counts, class_marginals, error_rates):
         Likelihood given current parameter estimates
     """
 
-    [nPatients, nObservers, nClasses] = np.shape(counts)
-    log_L = 0.0
-
-    for i in range(nPatients):
-        patient_likelihood = 0.0
-        for j in range(nClasses):
-
-            class_prior = class_marginals[j]
-            patient_class_likelihood = np.prod(
-                np.power(error_rates[:, j, :], counts[i, :, :]))
-            patient_class_posterior = class_prior * patient_class_likelihood
-            patient_likelihood += patient_class_posterior
-
-        temp = log_L + np.log(patient_likelihood)
-
-        if np.isnan(temp) or np.isinf(temp):
-            if args['verbose']:
-                print(i, log_L, np.log(patient_likelihood), temp)
-            sys.exit()
-
-        log_L = temp
+    # sum over patients of the log of the summed class posteriors, computed in log space to avoid underflow
+    log_L = np.sum(logsumexp(log_class_estimates(counts, class_marginals, error_rates), 1))
 
     return log_L
 
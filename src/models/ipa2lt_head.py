@@ -1,4 +1,4 @@
-from .utils import initialize_weight, initialize_bias_matrices
+from .utils import initialize_weight, initialize_bias_matrices, initialize_stacked_bias_matrices
 from .basic import BasicNetwork
 
 import torch.nn as nn
@@ -6,27 +6,37 @@ import torch
 
 
 class Ipa2ltHead(nn.Module):
-    def __init__(self, embedding_dim, label_dim, annotator_dim, use_softmax=True, apply_log=False):
+    def __init__(self, embedding_dim, label_dim, annotator_dim, use_softmax=True, apply_log=False, embedding_matrix=None):
         super().__init__()
 
         self.annotator_dim = annotator_dim
         self.label_dim = label_dim
         self.apply_log = apply_log
-        self.basic_network = BasicNetwork(embedding_dim, label_dim, use_softmax=use_softmax)
+        self.basic_network = BasicNetwork(embedding_dim, label_dim, use_softmax=use_softmax,
+                                          embedding_matrix=embedding_matrix)
         self.bias_matrices = nn.ModuleList([nn.Linear(label_dim, label_dim, bias=False) for i in range(annotator_dim)])
 
         self.basic_network.apply(initialize_weight)
         self.bias_matrices.apply(initialize_bias_matrices)
+        self.normalize_bias_matrices()
+        # checkpoints may hold bias matrices as they were after an optimizer step
+        self.register_load_state_dict_post_hook(self._normalize_loaded_bias_matrices)
+
+    @staticmethod
+    def _normalize_loaded_bias_matrices(module, incompatible_keys):
+        module.normalize_bias_matrices()
+
+    def normalize_bias_matrices(self):
+        """Normalize the rows of the bias matrices, the solver calls this after every optimizer step"""
+        with torch.no_grad():
+            for matrix in self.bias_matrices:
+                matrix.weight.copy_((matrix.weight / torch.norm(matrix.weight, dim=1, p=1, keepdim=True)).abs())
 
     def forward(self, x):
 
         x = self.basic_network(x)
         out = []
         for matrix in self.bias_matrices:
-            # normalize rows of bias matrices
-            normalized = matrix.weight / torch.norm(matrix.weight, dim=1, p=1, keepdim=True)
-            matrix.weight = nn.Parameter(normalized.abs())
-
             # forward pass, latent truth dimension is last dimension in x [batch_size, latent_truth]
             pred = torch.matmul(x, matrix.weight)
             if self.apply_log:
@@ -34,3 +44,51 @@ class Ipa2ltHead(nn.Module):
             out.append(pred)
 
         return out
+
+    def get_bias_matrix(self, idx):
+        return self.bias_matrices[idx].weight
+
+
+class StackedIpa2ltHead(nn.Module):
+    """
+    Ipa2ltHead with the bias matrices of all annotators stacked into one [annotator_dim, label_dim, label_dim] parameter.
+    Rows are normalized as a reparametrisation |w| / sum(|w|), so the parameter is never reallocated and
+    all annotators are computed in one batched matmul. Returns a tensor [annotator_dim, batch_size, label_dim].
+    """
+
+    def __init__(self, embedding_dim, label_dim, annotator_dim, use_softmax=True, apply_log=False, embedding_matrix=None):
+        super().__init__()
+
+        self.annotator_dim = annotator_dim
+        self.label_dim = label_dim
+        self.apply_log = apply_log
+        self.basic_network = BasicNetwork(embedding_dim, label_dim, use_softmax=use_softmax,
+                                          embedding_matrix=embedding_matrix)
+        self.bias_matrices = nn.Parameter(initialize_stacked_bias_matrices(annotator_dim, label_dim))
+
+        self.basic_network.apply(initialize_weight)
+        # checkpoints of Ipa2ltHead store one weight per annotator
+        self.register_load_state_dict_pre_hook(self._stack_bias_matrices)
+
+    @staticmethod
+    def _stack_bias_matrices(module, state_dict, prefix, *args):
+        keys = [f'{prefix}bias_matrices.{i}.weight' for i in range(module.annotator_dim)]
+        if all(key in state_dict for key in keys):
+            state_dict[f'{prefix}bias_matrices'] = torch.stack([state_dict.pop(key) for key in keys])
+
+    def normalized_bias_matrices(self):
+        weight = self.bias_matrices.abs()
+        return weight / weight.sum(dim=2, keepdim=True)
+
+    def get_bias_matrix(self, idx):
+        return self.normalized_bias_matrices()[idx]
+
+    def forward(self, x):
+
+        x = self.basic_network(x)
+        # [batch_size, latent_truth] x [annotator_dim, latent_truth, label_dim] -> [annotator_dim, batch_size, label_dim]
+        out = torch.matmul(x, self.normalized_bias_matrices())
+        if self.apply_log:
+            out = torch.clamp(torch.log(torch.clamp(out, 1e-5)), -100.0)
+
+        return out
@@ -0,0 +1,174 @@
+"""
+MACE (Multi-Annotator Competence Estimation, Hovy et al. 2013) estimated with EM or variational Bayes.
+Every annotator either knows the true label of a question and answers it (with probability theta, the competence)
+or spams a label drawn from its own spamming strategy xi. All random restarts are run at once along a leading axis.
+"""
+from __future__ import print_function
+
+import numpy as np
+from scipy.special import digamma, logsumexp
+
+from .dawid_skene import responses_to_sparse_counts
+
+
+def run(responses, args, tol=1e-5):
+    """
+    Run MACE on response data
+
+    Args:
+        responses: a dictionary object of responses:
+            {questions: {participants: [labels]}}
+        args: Must contain verbose whose value should be either True or False
+            May contain iterations (default 50), restarts (default 10), variational (default False),
+            alpha and beta (parameters of the beta prior on the competences, default 0.5 and 0.5),
+            smoothing (added to the expected counts of EM, default 0.01 / number of classes) and seed
+        tol: threshold for the change in log-likelihood for convergence of the algorithm
+
+    Returns:
+        The estimated label for each question: [nQuestions]
+    """
+
+    (questions, participants, classes, counts) = responses_to_sparse_counts(responses)
+    if args['verbose']:
+        print("Number of Questions:", len(questions))
+        print("Number of Participants:", len(participants))
+        print("Classes:", classes)
+
+    question_classes, competences, strategies, log_L = fit(
+        counts, iterations=args.get('iterations', 50), restarts=args.get('restarts', 10),
+        variational=args.get('variational', False), alpha=args.get('alpha', 0.5), beta=args.get('beta', 0.5),
+        smoothing=args.get('smoothing', None), tol=tol, seed=args.get('seed', None), verbose=args['verbose'])
+
+    if args['verbose']:
+        np.set_printoptions(precision=2, suppress=True)
+        print("Log-likelihood:", log_L)
+        print("Competences")
+        print(competences)
+
+    result = np.argmax(question_classes, axis=1)
+
+    return result
+
+
+def fit(counts, iterations=50, restarts=10, variational=False, alpha=0.5, beta=0.5, smoothing=None,
+        tol=1e-5, seed=None, verbose=False):
+    """
+    Estimate the MACE parameters of the restart with the highest log-likelihood
+
+    Args:
+        counts: SparseCounts of the responses [questions x participants x classes]
+        iterations: maximum number of iterations of EM
+        restarts: number of random initializations run in parallel
+        variational: use variational Bayes updates instead of EM
+        alpha, beta: parameters of the beta prior on the competences (variational only)
+        smoothing: added to the expected counts in the EM updates, default 0.01 / number of classes
+        tol: threshold for the change in log-likelihood for convergence
+        seed: seed of the random initialization
+
+    Returns:
+        question_classes: posterior of the true classes [questions x classes]
+        competences: probability of each participant knowing the answer [participants]
+        strategies: spamming distribution of each participant [participants x classes]
+        log_L: log-likelihood of the returned estimates
+    """
+
+    [nQuestions, nParticipants, nClasses] = np.shape(counts)
+    if smoothing is None:
+        smoothing = 0.01 / nClasses
+    random_state = np.random.RandomState(seed)
+
+    competences = random_state.uniform(0.5, 1.0, [restarts, nParticipants])
+    strategies = random_state.uniform(0.0, 1.0, [restarts, nParticipants, nClasses])
+    strategies /= np.sum(strategies, 2, keepdims=True)
+    knowing, spamming = competences, 1 - competences
+
+    old_log_L = None
+    for nIter in range(1, iterations + 1):
+        question_classes, log_L, known = e_step(counts, knowing, spamming, strategies)
+        competences, strategies, knowing, spamming = m_step(counts, question_classes, known, variational,
+                                                            alpha, beta, smoothing)
+
+        if verbose:
+            print(nIter, '\t', np.max(log_L))
+        if old_log_L is not None and np.max(np.abs(log_L - old_log_L)) < tol:
+            break
+        old_log_L = log_L
+
+    question_classes, log_L, _ = e_step(counts, knowing, spamming, strategies)
+    best = np.argmax(log_L)
+
+    return question_classes[best], competences[best], strategies[best], log_L[best]
+
+
+def e_step(counts, knowing, spamming, strategies):
+    """
+    E Step for the EM algorithm, for all restarts at once
+    Args:
+        counts: SparseCounts of the responses [questions x participants x classes]
+        knowing: (unnormalized) probability of each participant knowing the answer [restarts x participants]
+        spamming: (unnormalized) probability of each participant spamming [restarts x participants]
+        strategies: spamming distribution of each participant [restarts x participants x classes]
+    Returns:
+        question_classes: posterior of the true classes [restarts x questions x classes]
+        log_L: log-likelihood of each restart [restarts]
+        known: posterior probability of each response being given knowingly [restarts x responses]
+    """
+
+    [nQuestions, nParticipants, nClasses] = np.shape(counts)
+    question_idx, participant_idx, class_idx = counts.question_idx, counts.participant_idx, counts.class_idx
+
+    # probability of a response given a wrong true class (spamming) or the answered one (knowing or spamming)
+    spam_probability = spamming[:, participant_idx] * strategies[:, participant_idx, class_idx]
+    answer_probability = knowing[:, participant_idx] + spam_probability
+    log_spam_probability = np.log(np.maximum(spam_probability, 1e-300))
+
+    # uniform prior over the true classes
+    log_question_classes = np.full([len(knowing), nQuestions, nClasses], -np.log(nClasses))
+    np.add.at(log_question_classes, (slice(None), question_idx),
+              (counts.count * log_spam_probability)[:, :, None])
+    np.add.at(log_question_classes, (slice(None), question_idx, class_idx),
+              counts.count * (np.log(answer_probability) - log_spam_probability))
+
+    log_question_sums = logsumexp(log_question_classes, 2, keepdims=True)
+    question_classes = np.exp(log_question_classes - log_question_sums)
+    log_L = np.sum(log_question_sums, (1, 2))
+
+    known = question_classes[:, question_idx, class_idx] * knowing[:, participant_idx] / answer_probability
+
+    return question_classes, log_L, known
+
+
+def m_step(counts, question_classes, known, variational, alpha, beta, smoothing):
+    """
+    M Step for the EM algorithm (or the variational update), for all restarts at once
+    Returns:
+        competences: probability of each participant knowing the answer [restarts x participants]
+        strategies: spamming distribution of each participant [restarts x participants x classes]
+        knowing, spamming: weights of knowing and spamming used in the next E step [restarts x participants]
+    """
+
+    [nQuestions, nParticipants, nClasses] = np.shape(counts)
+    restarts = len(question_classes)
+    participant_idx, class_idx = counts.participant_idx, counts.class_idx
+
+    known_counts = np.zeros([restarts, nParticipants])
+    np.add.at(known_counts, (slice(None), participant_idx), counts.count * known)
+    total_counts = np.zeros(nParticipants)
+    np.add.at(total_counts, participant_idx, counts.count)
+    spam_counts = np.zeros([restarts, nParticipants, nClasses])
+    np.add.at(spam_counts, (slice(None), participant_idx, class_idx), counts.count * (1 - known))
+
+    if variational:
+        normalizer = digamma(total_counts + alpha + beta)
+        knowing = np.exp(digamma(known_counts + alpha) - normalizer)
+        spamming = np.exp(digamma(total_counts - known_counts + beta) - normalizer)
+        competences = knowing / (knowing + spamming)
+        strategies = np.exp(digamma(spam_counts + smoothing) -
+                            digamma(np.sum(spam_counts, 2, keepdims=True) + nClasses * smoothing))
+        strategies /= np.sum(strategies, 2, keepdims=True)
+    else:
+        competences = (known_counts + smoothing) / (total_counts + 2 * smoothing)
+        knowing, spamming = competences, 1 - competences
+        strategies = (spam_counts + smoothing) / (np.sum(spam_counts, 2, keepdims=True) + nClasses * smoothing)
+
+    return competences, strategies, knowing, spamming
@@ -12,3 +12,8 @@ def initialize_bias_matrices(module):
         module.weight = nn.Parameter(module.weight + torch.rand(module.weight.shape) * 0.1)
         normalized = module.weight / torch.norm(module.weight, dim=1, p=1, keepdim=True)
         module.weight = nn.Parameter(normalized.abs())
+
+
+def initialize_stacked_bias_matrices(annotator_dim, label_dim):
+    weight = torch.eye(label_dim).repeat(annotator_dim, 1, 1) + torch.rand(annotator_dim, label_dim, label_dim) * 0.1
+    return weight / weight.sum(dim=2, keepdim=True)
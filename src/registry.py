@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+
+def parse_checkpoint_name(file_name):
+    """
+    F1 score and epoch of a checkpoint file name written by get_model_path (f1 first, '_' as separator),
+    each None if the name has none (models saved without f1). None for files that are no checkpoints
+    (e.g. logs, optimizer states or reports)
+    """
+    if not file_name.endswith('.pt') or file_name.endswith('_optimizer.pt'):
+        return None
+    parts = file_name[:-len('.pt')].split('_')
+    try:
+        f1 = float(parts[0])
+    except ValueError:
+        f1 = None
+    epoch = None
+    for part in parts[1:]:
+        if part.startswith('epoch') and part[len('epoch'):].isdigit():
+            epoch = int(part[len('epoch'):])
+    return f1, epoch
+
+
+class RunRegistry(object):
+    """
+    SQLite index of all saved checkpoints: phase, dataset, task, annotator, hyperparameters, epoch, metrics and path.
+    Lookups of the best checkpoint of a directory are indexed queries instead of directory scans.
+    Connections are opened lazily per process and thread, so registries can be passed to worker processes
+    and used from background threads (e.g. the callbacks of a CheckpointWriter).
+    """
+
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        local = self._local
+        if getattr(local, 'connection', None) is None or local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory != '':
+                os.makedirs(directory, exist_ok=True)
+            local.connection = sqlite3.connect(self.path, timeout=self.timeout)
+            local.pid = os.getpid()
+            with local.connection:
+                local.connection.execute('''
+                    CREATE TABLE IF NOT EXISTS checkpoints (
+                        path TEXT PRIMARY KEY,
+                        directory TEXT NOT NULL,
+                        file_name TEXT NOT NULL,
+                        phase TEXT, dataset TEXT, task TEXT, annotator TEXT,
+                        batch_size INTEGER, lr REAL, hyperparams TEXT,
+                        epoch INTEGER, f1 REAL, metrics TEXT,
+                        early_stopping INTEGER DEFAULT 0,
+                        created REAL
+                    )''')
+                local.connection.execute(
+                    'CREATE INDEX IF NOT EXISTS checkpoints_directory_f1 ON checkpoints (directory, f1)')
+                local.connection.execute(
+                    'CREATE INDEX IF NOT EXISTS checkpoints_phase_annotator_f1 ON checkpoints (phase, annotator, f1)')
+                # modification time of every indexed directory, it is only listed again once it changed
+                local.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS directories (directory TEXT PRIMARY KEY, mtime INTEGER NOT NULL)')
+        return local.connection
+
+    @staticmethod
+    def _directory(path):
+        return os.path.abspath(path)
+
+    def record(self, path, epoch=None, f1=None, metrics=None, hyperparams=None, early_stopping=False, **tags):
+        """Add or replace the entry of the checkpoint at path, tags are phase, dataset, task and annotator"""
+        hyperparams = hyperparams or {}
+        with self.connection as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO checkpoints (path, directory, file_name, phase, dataset, task, annotator, '
+                'batch_size, lr, hyperparams, epoch, f1, metrics, early_stopping, created) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (os.path.abspath(path), self._directory(os.path.dirname(path)), os.path.basename(path),
+                 tags.get('phase'), tags.get('dataset'), tags.get('task'), tags.get('annotator'),
+                 hyperparams.get('batch'), hyperparams.get('lr'), json.dumps(hyperparams, default=str),
+                 epoch, f1, json.dumps(metrics, default=str) if metrics is not None else None,
+                 int(early_stopping), time.time()))
+
+    def remove(self, path):
+        """Remove the entry of the checkpoint at path, e.g. when the file is deleted"""
+        with self.connection as connection:
+            connection.execute('DELETE FROM checkpoints WHERE path = ?', (os.path.abspath(path),))
+
+    def index_directory(self, directory):
+        """
+        Bring the entries of a directory in line with its files if it changed since it was last indexed:
+        checkpoints that are not recorded yet (e.g. saved before the registry was used) are recorded from their
+        file names and entries of deleted files are removed. Returns the number of newly recorded checkpoints.
+        """
+        mtime = os.stat(directory).st_mtime_ns
+        row = self.connection.execute(
+            'SELECT mtime FROM directories WHERE directory = ?', (self._directory(directory),)).fetchone()
+        if row is not None and row[0] == mtime:
+            return 0
+
+        file_names = set(os.listdir(directory))
+        recorded = set(row[0] for row in self.connection.execute(
+            'SELECT file_name FROM checkpoints WHERE directory = ?', (self._directory(directory),)))
+        checkpoints = []
+        for file_name in file_names - recorded:
+            parsed = parse_checkpoint_name(file_name)
+            if parsed is not None:
+                checkpoints.append((file_name, *parsed))
+        with self.connection as connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO checkpoints (path, directory, file_name, epoch, f1, created) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(os.path.abspath(os.path.join(directory, file_name)), self._directory(directory), file_name,
+                  epoch, f1, time.time()) for file_name, f1, epoch in checkpoints])
+            connection.executemany(
+                'DELETE FROM checkpoints WHERE directory = ? AND file_name = ?',
+                [(self._directory(directory), file_name) for file_name in recorded - file_names])
+            connection.execute('INSERT OR REPLACE INTO directories (directory, mtime) VALUES (?, ?)',
+                               (self._directory(directory), mtime))
+        return len(checkpoints)
+
+    def file_names(self, directory):
+        """File names of all recorded checkpoints in directory, ordered by f1 (best first, those without f1 last)"""
+        rows = self.connection.execute(
+            'SELECT file_name FROM checkpoints WHERE directory = ? ORDER BY f1 DESC, created DESC',
+            (self._directory(directory),)).fetchall()
+        return [row[0] for row in rows]
+
+    def best_file_name(self, directory):
+        """File name of the checkpoint with the highest f1 in directory, None if none is recorded"""
+        row = self.connection.execute(
+            'SELECT file_name FROM checkpoints WHERE directory = ? ORDER BY f1 DESC, created DESC LIMIT 1',
+            (self._directory(directory),)).fetchone()
+        return row[0] if row is not None else None
+
+    def close(self):
+        """Close the connection of the calling thread"""
+        if getattr(self._local, 'connection', None) is not None:
+            self._local.connection.close()
+            self._local.connection = None
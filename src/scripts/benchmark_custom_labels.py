@@ -0,0 +1,67 @@
+"""
+Benchmark of BaseDataset.use_custom_labels against the quadratic loop it replaced, on random data
+with duplicate texts. Checks that both keep the same points and prints the runtime of each.
+Run from src: PYTHONPATH=. python scripts/benchmark_custom_labels.py
+"""
+import copy
+import random
+import time
+
+from datasets import BaseDataset
+
+# Config
+SIZES = [500, 1000, 2000, 4000, 8000]
+REPEATS = 3
+SEED = 0
+
+
+class RecordDataset(BaseDataset):
+    """BaseDataset over given records, without a text processor"""
+
+    def __init__(self, data):
+        super().__init__()
+        self.data = data
+
+    def _build_text_processor(self, **argv):
+        pass
+
+
+def use_custom_labels_list_scan(data, sample_label_map):
+    """use_custom_labels before the linear pass: list membership tests and a rebuilt list of kept texts"""
+    samples = list(sample_label_map.keys())
+    new_data = []
+    for point in data:
+        if point['text'] in samples and point['text'] not in [new_point['text'] for new_point in new_data]:
+            point['label'] = sample_label_map[point['text']]
+            point['annotator'] = 'custom'
+            new_data.append(point)
+    return new_data
+
+
+def best_time(func, make_args):
+    times = []
+    for _ in range(REPEATS):
+        args = make_args()
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+rng = random.Random(SEED)
+print(f'{"points":>8} {"list scan [s]":>14} {"linear [s]":>11} {"speedup":>8}')
+for size in SIZES:
+    data = [{'text': f'text {rng.randint(0, size // 2)}', 'label': 0, 'annotator': 'a'} for _ in range(size)]
+    sample_label_map = {f'text {i}': i % 3 for i in range(0, size // 2, 2)}
+
+    old_time, old_data = best_time(use_custom_labels_list_scan,
+                                   lambda: (copy.deepcopy(data), sample_label_map))
+
+    def use_custom_labels(dataset):
+        dataset.use_custom_labels(sample_label_map)
+        return dataset.data['train']
+    new_time, new_data = best_time(use_custom_labels,
+                                   lambda: (RecordDataset({'train': copy.deepcopy(data)}),))
+
+    assert old_data == new_data, 'use_custom_labels keeps different points than the list scan'
+    print(f'{size:>8} {old_time:>14.5f} {new_time:>11.5f} {old_time / new_time:>7.1f}x')
@@ -0,0 +1,111 @@
+"""
+Benchmark of keeping one optimizer per fit against re-creating it before every step, as fit did before.
+Trains the same model on synthetic annotator data both ways from several seeds and prints the mean steps per
+second, final training loss and validation f1 of each (the outcome of single runs depends a lot on the seed).
+Run from src: PYTHONPATH=. python scripts/benchmark_optimizer.py
+"""
+import time
+import numpy as np
+import torch
+
+from datasets import BaseDataset
+from metric_sinks import MetricsSink
+from solver import Solver
+
+# Config
+EPOCHS = 10
+BATCH_SIZE = 64
+LEARNING_RATE = 1e-2
+NUM_SAMPLES = 4000
+ANNOTATORS = ['a', 'b', 'c']
+PADDING_LENGTH = 20
+EMBEDDING_DIM = 50
+OPTIMIZER_NAME = 'adam'
+FUSED_STEP = True
+SEEDS = [0, 1, 2, 3, 4]
+
+
+class SyntheticDataset(BaseDataset):
+    """
+    Random word vectors shifted along the first dimension for label 1 and along the second one for label 0.
+    Each annotator flips a different share of the labels.
+    """
+
+    def __init__(self, num_samples, annotators, seed=0):
+        super().__init__(padding_length=PADDING_LENGTH, embedding_dim=EMBEDDING_DIM)
+        random_state = np.random.RandomState(seed)
+        self.annotators = annotators
+        embeddings = random_state.normal(size=(num_samples, PADDING_LENGTH, EMBEDDING_DIM)).astype(np.float32)
+        truth = random_state.randint(2, size=num_samples)
+        embeddings[np.arange(num_samples), :, 1 - truth] += 2.0
+        annotator_idx = random_state.randint(len(annotators), size=num_samples)
+        flip = random_state.uniform(size=num_samples) < 0.1 * (annotator_idx + 1)
+        labels = np.where(flip, 1 - truth, truth)
+        data = [{'text': str(i), 'embedding': embeddings[i], 'label': int(labels[i]),
+                 'annotator': annotators[annotator_idx[i]], 'pseudo_labels': {}} for i in range(num_samples)]
+        eof_train_split, eof_val_split = int(num_samples * 0.8), int(num_samples * 0.9)
+        self.data = {'train': data[:eof_train_split], 'validation': data[eof_train_split:eof_val_split],
+                     'test': data[eof_val_split:]}
+
+    def _build_text_processor(self, **argv):
+        pass
+
+
+class RecreatedOptimizer(object):
+    """Creates a new optimizer before every step, so its moments never outlive a batch"""
+
+    def __init__(self, solver, parameters):
+        self.solver = solver
+        self.parameters = list(parameters)
+        self.optimizer = None
+
+    def zero_grad(self):
+        self.optimizer = Solver.initialize_optimizer(self.solver, self.parameters)
+        self.optimizer.zero_grad()
+
+    def step(self):
+        self.optimizer.step()
+
+
+class RecreatingOptimizerSolver(Solver):
+    def initialize_optimizer(self, parameters):
+        return RecreatedOptimizer(self, parameters)
+
+
+class MemoryMetricsSink(MetricsSink):
+    """Keeps all logged rows (step, tag, value) in memory"""
+
+    def __init__(self):
+        super().__init__(flush_every=None)
+        self.rows = []
+
+    def _write(self, rows):
+        self.rows.extend(rows)
+
+
+def benchmark(solver_class, dataset, seed):
+    """Steps per second, training loss of the last epoch (mean over annotators) and validation f1"""
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    metrics_sink = MemoryMetricsSink()
+    solver = solver_class(dataset, LEARNING_RATE, BATCH_SIZE, optimizer_name=OPTIMIZER_NAME, loss='nll_log',
+                          label_dim=2, annotator_dim=len(ANNOTATORS), embedding_dim=EMBEDDING_DIM,
+                          stacked_head=True, verbose=False, metrics_sink=metrics_sink)
+    dataset.set_mode('train')
+    steps_per_epoch = int(np.ceil(len(dataset) / BATCH_SIZE))
+
+    start = time.perf_counter()
+    _, f1 = solver.fit(EPOCHS, return_f1=True, deep_randomization=True, fused_step=FUSED_STEP)
+    seconds = time.perf_counter() - start
+
+    train_losses = [value for step, tag, value in metrics_sink.rows
+                    if step == EPOCHS - 1 and tag.startswith('Loss/') and tag.endswith('/train')]
+    return EPOCHS * steps_per_epoch / seconds, float(np.mean(train_losses)), float(f1)
+
+
+dataset = SyntheticDataset(NUM_SAMPLES, ANNOTATORS)
+print(f'{"optimizer":>22} {"steps/s":>9} {"train loss":>11} {"val f1":>7}')
+for name, solver_class in [('re-created every step', RecreatingOptimizerSolver), ('one per fit', Solver)]:
+    results = np.array([benchmark(solver_class, dataset, seed) for seed in SEEDS])
+    steps_per_second, train_loss, f1 = results.mean(axis=0)
+    print(f'{name:>22} {steps_per_second:>9.1f} {train_loss:>11.4f} {f1:>7.4f}')
@@ -11,6 +11,7 @@ from datasets.emotion import EmotionDataset
 from datasets.wikipedia import WikipediaDataset
 from datasets.organic import OrganicDataset
 from training import training_loop
+from registry import RunRegistry
 from utils import *
 
 # Config
@@ -106,11 +107,16 @@ fit_params = {
     'early_stopping_interval': EARLY_STOPPING_INTERVAL,
 }
 models_root_path = f'../models/{local_folder}'
+# all checkpoints are recorded in the run registry, best model lookups query it instead of scanning directories
+registry = RunRegistry('../models/registry.sqlite')
 pseudo_func_args = {
     'pseudo_root': models_root_path,
     'phase': 'individual_training',
+    'registry': registry,
 }
 pseudo_model_path_func = get_pseudo_model_path
+# pseudo labels are cached per individual model checkpoint and reused across the hyperparameter grid
+pseudo_cache_path = f'{models_root_path}/pseudo_label_cache'
 
 # # #  Training  # # #
 # Emotions Loop (comment out as needed)
@@ -139,7 +145,8 @@ for phase in phases:
                 'single_annotator': annotator,
             })
             training_loop(dataset, BATCH_SIZES, learning_rates, local_folder, EPOCHS_PHASES[0],
-                          solver_params_copy, fit_params_copy, phase_path=phase, annotator_path=annotator)
+                          solver_params_copy, fit_params_copy, phase_path=phase, annotator_path=annotator,
+                          registry=registry, tags={'task': task})
 
     if phase is 'pretraining':
         learning_rates = get_learning_rates(
@@ -154,7 +161,8 @@ for phase in phases:
             'basic_only': True,
         })
         training_loop(dataset, BATCH_SIZES, learning_rates, local_folder, EPOCHS_PHASES[1],
-                      solver_params_copy, fit_params_copy, phase_path=phase)
+                      solver_params_copy, fit_params_copy, phase_path=phase,
+                      registry=registry, tags={'task': task})
 
     if phase is 'ltnet_true':
         learning_rates = get_learning_rates(
@@ -163,7 +171,7 @@ for phase in phases:
         solver_params_copy.update({
             'save_at': SAVE_MODEL_AT_PHASES[2],
             # get best model from pretraining
-            # 'model_weights_path': get_best_model_path(f'{models_root_path}/{phases[1]}'),
+            # 'model_weights_path': get_best_model_path(f'{models_root_path}/{phases[1]}', registry=registry),
         })
         fit_params_copy = fit_params.copy()
         fit_params_copy.update({
@@ -171,7 +179,8 @@ for phase in phases:
             'pretrained_basic': False,
         })
         training_loop(dataset, BATCH_SIZES, learning_rates, local_folder, EPOCHS_PHASES[3],
-                      solver_params_copy, fit_params_copy, phase_path=phase)
+                      solver_params_copy, fit_params_copy, phase_path=phase,
+                      registry=registry, tags={'task': task})
 
     if phase is 'ltnet_pseudo':
         learning_rates = get_learning_rates(
@@ -180,10 +189,11 @@ for phase in phases:
         solver_params_copy.update({
             'save_at': SAVE_MODEL_AT_PHASES[3],
             # get best model from pretraining
-            'model_weights_path': get_best_model_path(f'{models_root_path}/{phases[1]}'),
+            'model_weights_path': get_best_model_path(f'{models_root_path}/{phases[1]}', registry=registry),
             'pseudo_annotators': dataset.annotators,
             'pseudo_model_path_func': pseudo_model_path_func,
             'pseudo_func_args': pseudo_func_args,
+            'pseudo_cache_path': pseudo_cache_path,
         })
         fit_params_copy = fit_params.copy()
         fit_params_copy.update({
@@ -191,7 +201,8 @@ for phase in phases:
             'pretrained_basic': True,
         })
         training_loop(dataset, BATCH_SIZES, learning_rates, local_folder, EPOCHS_PHASES[2],
-                      solver_params_copy, fit_params_copy, phase_path=phase)
+                      solver_params_copy, fit_params_copy, phase_path=phase,
+                      registry=registry, tags={'task': task})
         dataset.remove_pseudo_labels()
 
     if phase is 'basic_true':
@@ -201,7 +212,7 @@ for phase in phases:
         solver_params_copy.update({
             'save_at': SAVE_MODEL_AT_PHASES[4],
             # get best model from pretraining
-            'model_weights_path': get_best_model_path(f'{models_root_path}/{phases[1]}'),
+            'model_weights_path': get_best_model_path(f'{models_root_path}/{phases[1]}', registry=registry),
         })
         fit_params_copy = fit_params.copy()
         fit_params_copy.update({
@@ -210,7 +221,8 @@ for phase in phases:
             'basic_only': True,
         })
         training_loop(dataset, BATCH_SIZES, learning_rates, local_folder, EPOCHS_PHASES[5],
-                      solver_params_copy, fit_params_copy, phase_path=phase)
+                      solver_params_copy, fit_params_copy, phase_path=phase,
+                      registry=registry, tags={'task': task})
 
     if phase is 'basic_pseudo':
         learning_rates = get_learning_rates(
@@ -219,10 +231,11 @@ for phase in phases:
         solver_params_copy.update({
             'save_at': SAVE_MODEL_AT_PHASES[5],
             # get best model from pretraining
-            'model_weights_path': get_best_model_path(f'{models_root_path}/{phases[1]}'),
+            'model_weights_path': get_best_model_path(f'{models_root_path}/{phases[1]}', registry=registry),
             'pseudo_annotators': dataset.annotators,
             'pseudo_model_path_func': pseudo_model_path_func,
             'pseudo_func_args': pseudo_func_args,
+            'pseudo_cache_path': pseudo_cache_path,
         })
         fit_params_copy = fit_params.copy()
         fit_params_copy.update({
@@ -231,5 +244,6 @@ for phase in phases:
             'basic_only': True,
         })
         training_loop(dataset, BATCH_SIZES, learning_rates, local_folder, EPOCHS_PHASES[2],
-                      solver_params_copy, fit_params_copy, phase_path=phase)
+                      solver_params_copy, fit_params_copy, phase_path=phase,
+                      registry=registry, tags={'task': task})
         dataset.remove_pseudo_labels()
@@ -2,12 +2,11 @@ import sys
 import math
 import torch
 import pickle
-import pandas as pd
-import subprocess
 from collections import Counter
 import matplotlib.pyplot as plt
 
 import models.dawid_skene as ds
+import models.mace as mace
 from solver import Solver
 from training import training_loop
 from datasets.tripadvisor import TripAdvisorDataset
@@ -23,11 +22,15 @@ MODES = ['validation', 'test', 'train']  # set to only ['train'] when training
 
 LOCAL_FOLDER = 'train_02_14/sgd/nll'
 DEVICE = torch.device('cuda')
-MACE_PATH = '../../MACE'
-MACE_ITER = 1000
+MACE_ARGS = {
+    'iterations': 1000,
+    'restarts': 10,
+    'verbose': True
+}
 DS_ARGS = {
     'algorithm': 'FDS',
-    'verbose': True
+    'verbose': True,
+    'sparse': True
 }
 if METHOD not in ['dawid_skene', 'mace', 'majority_voting']:
     sys.exit()
@@ -164,42 +167,18 @@ for mode in MODES:
         for pseudo_ann in list(data_point['pseudo_labels'].keys()):
             data[text][pseudo_ann] = [data_point['pseudo_labels'][pseudo_ann].item()]
 
-    if METHOD == 'dawid_skene':
-        # dawid_skene only for train set
-        samples, labels = ds.run(data, DS_ARGS)
-
-        # save labels in pickle
-        labels_map = {samples[i]: labels[i] for i in range(len(samples))}
-        f = open(labels_path, "wb")
-        pickle.dump(labels_map, f)
-        f.close()
-        dataset.remove_pseudo_labels()
-
-    if METHOD == 'mace':
-        mace_data = [[ann_item[1][0] for ann_item in list(data_item[1].items())] for data_item in list(data.items())]
-        mace_df = pd.DataFrame(mace_data)
-        mace_csv_path = f'{labels_path_root}/crowdsourced_labels.csv'
-        mace_df.to_csv(mace_csv_path, header=False, index=False)
-
-        # run MACE with bash command
-        %cd $labels_path_root
-        src_path = '../../..'
-        if dataset_name is 'tripadvisor':
-            src_path += '/..'
-        src_path += '/src'
-        command = f'{src_path}/{MACE_PATH}/MACE --prefix mace_labels --iterations {MACE_ITER} {src_path}/{mace_csv_path}'
-        process = subprocess.Popen(command.split(), stdout=subprocess.PIPE)
-        output, error = process.communicate()
-        print(output)
-        %cd $src_path
-
-        # read labels
-        mace_labels_path = f'{labels_path_root}/mace_labels.prediction'
-        mace_labels = pd.read_csv(mace_labels_path, header=None)
-        labels = mace_labels[0].tolist()
+    if METHOD == 'dawid_skene' or METHOD == 'mace':
+        # results are indices into the sorted samples and labels
+        samples = sorted(data.keys())
+        labels = sorted(set(label for answers in data.values() for annotation in answers.values() for label in annotation))
+        if METHOD == 'dawid_skene':
+            # dawid_skene only for train set
+            results = ds.run(data, DS_ARGS)
+        else:
+            results = mace.run(data, MACE_ARGS)
 
         # save labels in pickle
-        labels_map = {data_item: labels[i] for i, data_item in enumerate(data)}
+        labels_map = {samples[i]: labels[results[i]] for i in range(len(samples))}
         f = open(labels_path, "wb")
         pickle.dump(labels_map, f)
         f.close()
@@ -7,6 +7,8 @@ from datasets.emotion import EmotionDataset
 from datasets.wikipedia import WikipediaDataset
 from datasets.organic import OrganicDataset
 from models.ipa2lt_head import Ipa2ltHead
+from registry import RunRegistry
+from utils import get_model_file_names
 
 # # # Setup # # #
 # Parameters independent of dataset #
@@ -14,6 +16,7 @@ DEVICE = torch.device('cuda')
 USE_SOFTMAX = True
 MODES = ['train', 'test']
 MODEL_ROOT = '../models'
+REGISTRY = RunRegistry(f'{MODEL_ROOT}/registry.sqlite')
 LOGS_ROOT = '../logs'
 AVG_BIAS_MATRICES = True
 
@@ -90,7 +93,7 @@ for phase in phases:
                 torch.zeros(bias_matrix.weight.shape))
 
     # Evaluation Loop #
-    for model_path in os.listdir(target_model_path):
+    for model_path in get_model_file_names(target_model_path, registry=REGISTRY):
 
         # modes loop (comment out as needed)
         for mode in MODES:
@@ -8,7 +8,8 @@ from datasets.emotion import EmotionDataset
 from datasets.wikipedia import WikipediaDataset
 from datasets.organic import OrganicDataset
 from models.ipa2lt_head import Ipa2ltHead
-from utils import get_best_model_path
+from registry import RunRegistry
+from utils import get_best_model_path, get_model_file_names
 
 # # # Setup # # #
 # Parameters independent of dataset #
@@ -16,6 +17,7 @@ DEVICE = torch.device('cuda')
 USE_SOFTMAX = True
 MODES = ['test', 'validation']
 MODEL_ROOT = '../models'
+REGISTRY = RunRegistry(f'{MODEL_ROOT}/registry.sqlite')
 LOGS_ROOT = '../logs'
 AVERAGING_METHOD = 'macro'
 
@@ -113,7 +115,7 @@ for iter_element in outer_iterator:
             local_folder = f'{local_folder_root}/{dataset_name}/{task}'
             model_root = f'{MODEL_ROOT}/{local_folder}'
             target_model_path = f'{model_root}/{phase}'
-            pretrained_model_path = get_best_model_path(f'{model_root}/pretraining')
+            pretrained_model_path = get_best_model_path(f'{model_root}/pretraining', registry=REGISTRY)
         if phase in ['dawid_skene', 'mace']:
             target_model_path = f'{MODEL_ROOT}/{local_folder_root}/{phase}/{dataset_name}/{task}'
             pretrained_model_path = ''
@@ -132,7 +134,7 @@ for iter_element in outer_iterator:
                 metrics_out = ''
                 metrics = {}
                 # Evaluation Loop #
-                for model_path in os.listdir(target_model_path):
+                for model_path in get_model_file_names(target_model_path, registry=REGISTRY):
 
                     if model_path.endswith('.pt'):
                         hyperparams, _ = (lambda x: (x[:-1], x[-1]))(model_path.split('.pt'))
@@ -1,10 +1,6 @@
 from torch.utils.tensorboard import SummaryWriter
-from tensorflow.python.framework import tensor_util
-from tensorflow.python.lib.io import tf_record
-from tensorflow.core.util import event_pb2
 from nltk.tokenize import RegexpTokenizer
 from collections import Counter
-import tensorflow as tf
 import torch
 import pytz
 import datetime
@@ -14,6 +10,8 @@ import numpy as np
 import pandas as pd
 import os
 
+from event_reader import scalar_events
+
 DEVICE = torch.device('cuda')
 ROOT = '../logs'
 LOCAL_FOLDER = 'train_02_14/sgd/nll'
@@ -146,11 +144,6 @@ model_paths = {
 
 
 # helper functions
-def my_summary_iterator(path):
-    for r in tf_record.tf_record_iterator(path):
-        yield event_pb2.Event.FromString(r)
-
-
 def add_arrow(line, position=None, direction='right', size=15, color=None, border_size=10):
     """
     add an arrow to a line.
@@ -242,24 +235,25 @@ for key in list(model_paths.keys()):
             directory += f'/{sub_dir}'
         sep = '_'
         writer_dir = f'{directory}/writer_{sep.join(writer_hyperparams)}'
-        writer_path = f'{writer_dir}/{os.listdir(writer_dir)[0]}'
+        # scalars are cached in writer_dir/.scalar_cache, only events appended since the last run are parsed
+        event_files = [file_name for file_name in os.listdir(writer_dir) if file_name.startswith('events.out.tfevents')]
+        writer_path = f'{writer_dir}/{event_files[0]}'
 
         model_loss[model_path] = {
             'train': {},
             'validation': {},
         }
-        for event in my_summary_iterator(writer_path):
-            for value in event.summary.value:
-                if TAG_KEY in value.tag:
-                    for mode in list(model_loss[model_path].keys()):
-                        if mode in value.tag:
-                            if event.step not in list(model_loss[model_path][mode].keys()):
-                                model_loss[model_path][mode][event.step] = {}
-                            _, annotator, _ = (lambda x: (x[0], x[1], x[2]))(
-                                value.tag.split('/'))
-                            _, annotator = (lambda x: (x[0], x[1]))(
-                                annotator.split(' '))
-                            model_loss[model_path][mode][event.step][annotator] = value.simple_value
+        for step, tag, value in scalar_events(writer_path):
+            if TAG_KEY in tag:
+                for mode in list(model_loss[model_path].keys()):
+                    if mode in tag:
+                        if step not in list(model_loss[model_path][mode].keys()):
+                            model_loss[model_path][mode][step] = {}
+                        _, annotator, _ = (lambda x: (x[0], x[1], x[2]))(
+                            tag.split('/'))
+                        _, annotator = (lambda x: (x[0], x[1]))(
+                            annotator.split(' '))
+                        model_loss[model_path][mode][step][annotator] = value
 
         if sub_dir == 'pretraining':
             pretraining_loss = model_loss[model_path]
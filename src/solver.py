@@ -4,13 +4,20 @@ import torch.nn as nn
 import torch.optim as optim
 from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
 from itertools import compress
+from functools import partial
 import time
 import sys
+import os
 
 from datasets.tripadvisor import TripAdvisorDataset
-from models.ipa2lt_head import Ipa2ltHead
+from models.ipa2lt_head import Ipa2ltHead, StackedIpa2ltHead
 from models.basic import BasicNetwork
-from utils import get_model_path
+from metrics import StreamingConfusionMatrix
+from checkpoint import CheckpointWriter
+from metric_sinks import get_metrics_sink
+from datasets.pipeline import DataPipeline
+from evaluation import get_sample_sink, format_evaluation_report, normalize_rows
+from utils import get_model_path, get_pseudo_label_cache_path, load_pseudo_label_map, save_pseudo_label_map
 
 
 class Solver(object):
@@ -20,7 +27,9 @@ class Solver(object):
                  embedding_dim=50, label_dim=2, annotator_dim=2, averaging_method='macro',
                  save_path_head=None, save_at=None, save_params=None, use_softmax=True,
                  pseudo_annotators=None, pseudo_model_path_func=None, pseudo_func_args={},
-                 optimizer_name='adam', early_stopping_margin=1e-4,
+                 optimizer_name='adam', early_stopping_margin=1e-4, pseudo_cache_path=None,
+                 stacked_head=False, scheduler_name=None, optimizer_state_path='', save_optimizer_state=False,
+                 pipeline_params=None, registry=None, checkpoint_writer=None, metrics_sink=None,
                  ):
         self.learning_rate = learning_rate
         self.batch_size = batch_size
@@ -33,8 +42,14 @@ class Solver(object):
         self.save_path_head = save_path_head
         self.save_at = save_at
         self.save_params = save_params
+        # RunRegistry every saved checkpoint is recorded in, save_params may hold its 'tags' (phase, dataset, ...)
+        self.registry = registry
+        # checkpoints are written on a background thread, fit waits for them and stops it before returning
+        self.checkpoint_writer = checkpoint_writer if checkpoint_writer is not None else CheckpointWriter()
         self.device = device
         self.writer = writer
+        # metrics are buffered in the sink and written once per epoch by default (to the writer if there is one)
+        self.metrics_sink = metrics_sink if metrics_sink is not None else get_metrics_sink(writer=writer)
         self.verbose = verbose
         self.averaging_method = averaging_method
         self.use_softmax = use_softmax
@@ -45,11 +60,23 @@ class Solver(object):
 
         # can either be 'sgd' or 'adam'
         self.optimizer_name = optimizer_name
+        # can either be None or 'cosine', stepped once per epoch
+        self.scheduler_name = scheduler_name
+        # optimizer and scheduler live for one call of fit, their state can be saved next to the model and restored
+        self.optimizer = None
+        self.scheduler = None
+        self.optimizer_state_path = optimizer_state_path
+        self.save_optimizer_state = save_optimizer_state
+
+        # use the head with all bias matrices in one stacked parameter
+        self.stacked_head = stacked_head
 
         # List with pseudo annotators and separate function for getting a model path
         self.pseudo_annotators = pseudo_annotators
         self.pseudo_model_path_func = pseudo_model_path_func
         self.pseudo_func_args = pseudo_func_args
+        # optional folder in which pseudo labels are cached per pseudo model checkpoint
+        self.pseudo_cache_path = pseudo_cache_path
 
         if pseudo_annotators is not None:
             self._create_pseudo_labels()
@@ -60,13 +87,28 @@ class Solver(object):
             from datasets import collate_wrapper
         self.collate_wrapper = collate_wrapper
 
+        # reusable data loaders, e.g. {'num_workers': 4, 'persistent_workers': True, 'pin_memory': True}
+        self.pipeline = None
+        if pipeline_params is not None:
+            self.pipeline = DataPipeline(self.dataset, self.batch_size, device=self.device, **pipeline_params)
+
+    def _get_loader(self, shuffle=False):
+        """Data loader over the current mode and annotator filter of the dataset"""
+        if self.pipeline is not None:
+            return self.pipeline.loader(self.dataset.mode, self.dataset.annotator_filter, shuffle=shuffle)
+        return torch.utils.data.DataLoader(
+            self.dataset, batch_size=self.batch_size, collate_fn=self.collate_wrapper, shuffle=shuffle)
+
     def _get_model(self, basic_only=False, pretrained_basic=False):
         if not basic_only:
-            model = Ipa2ltHead(self.embedding_dim, self.label_dim,
-                               self.annotator_dim, use_softmax=self.use_softmax, apply_log=self.loss == 'nll_log')
+            head = StackedIpa2ltHead if self.stacked_head else Ipa2ltHead
+            model = head(self.embedding_dim, self.label_dim,
+                         self.annotator_dim, use_softmax=self.use_softmax, apply_log=self.loss == 'nll_log',
+                         embedding_matrix=self.dataset.embedding_matrix)
         else:
             model = BasicNetwork(self.embedding_dim,
-                                 self.label_dim, use_softmax=self.use_softmax, apply_log=self.loss == 'nll_log')
+                                 self.label_dim, use_softmax=self.use_softmax, apply_log=self.loss == 'nll_log',
+                                 embedding_matrix=self.dataset.embedding_matrix)
         if self.model_weights_path is not '':
             if self.verbose:
                 print(
@@ -95,42 +137,110 @@ class Solver(object):
                     path += f'_early_stopping'
                 path += '.pt'
 
+                # the checkpoint is only recorded once it is written, so lookups never return a missing file
+                record = None
+                if self.registry is not None:
+                    record = partial(self.registry.record, path, epoch=epoch, f1=f1 if return_f1 else None,
+                                     metrics={'f1': f1} if return_f1 else None,
+                                     hyperparams=params['hyperparams'], early_stopping=early_stopping,
+                                     **params.get('tags', {}))
+
                 print(f'Saving model at: {path}')
-                torch.save(model.state_dict(), path)
+                self.checkpoint_writer.save(model.state_dict(), path, callback=record)
+                if self.save_optimizer_state:
+                    self.checkpoint_writer.save(self.get_optimizer_state(), self._optimizer_state_path(path))
 
     def _create_pseudo_labels(self):
         model = BasicNetwork(self.embedding_dim,
-                             self.label_dim, use_softmax=self.use_softmax)
+                             self.label_dim, use_softmax=self.use_softmax, embedding_matrix=self.dataset.embedding_matrix)
         for pseudo_ann in self.pseudo_annotators:
-            model.load_state_dict(torch.load(self.pseudo_model_path_func(
-                **self.pseudo_func_args, annotator=pseudo_ann)))
-            model.to(self.device)
+            model_path = self.pseudo_model_path_func(**self.pseudo_func_args, annotator=pseudo_ann)
             annotator_list = self.dataset.annotators.copy()
             annotator_list.remove(pseudo_ann)
-            for annotator in annotator_list:
-                self.dataset.create_pseudo_labels(annotator, pseudo_ann, model)
+
+            cache_path = None
+            if self.pseudo_cache_path is not None:
+                cache_path = get_pseudo_label_cache_path(self.pseudo_cache_path, model_path, self.dataset, pseudo_ann)
+                if os.path.exists(cache_path):
+                    missing = self.dataset.use_pseudo_label_map(
+                        annotator_list, pseudo_ann, load_pseudo_label_map(cache_path))
+                    if missing == 0:
+                        continue
+
+            model.load_state_dict(torch.load(model_path))
+            model.to(self.device)
+            model.eval()
+            # samples of all other annotators are labeled in one batched pass
+            self.dataset.create_pseudo_labels(annotator_list, pseudo_ann, model)
+
+            if cache_path is not None:
+                save_pseudo_label_map(cache_path, self.dataset.get_pseudo_label_map(pseudo_ann))
 
     def initialize_optimizer(self, parameters):
         if self.optimizer_name == 'adam':
             return optim.AdamW(
                 parameters,
-                lr=self.learning_rate, betas=(0.9, 0.999), eps=1e-08, weight_decay=0.01, amsgrad=False)
+                lr=float(self.learning_rate), betas=(0.9, 0.999), eps=1e-08, weight_decay=0.01, amsgrad=False)
         elif self.optimizer_name == 'sgd':
             return optim.SGD(
                 parameters,
-                lr=self.learning_rate, momentum=0.9, weight_decay=0.0005)
+                lr=float(self.learning_rate), momentum=0.9, weight_decay=0.0005)
+
+    def initialize_scheduler(self, optimizer, epochs):
+        if self.scheduler_name == 'cosine':
+            return optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=max(epochs, 1))
+        return None
+
+    @staticmethod
+    def _optimizer_state_path(model_path):
+        return model_path[:-len('.pt')] + '_optimizer.pt'
+
+    def save_checkpoint(self, model, path):
+        """Model and optimizer state to resume training from with fit(resume_path=path), waits until written"""
+        self.checkpoint_writer.save(model.state_dict(), path)
+        self.checkpoint_writer.save(self.get_optimizer_state(), self._optimizer_state_path(path))
+        self.checkpoint_writer.flush()
+
+    def get_optimizer_state(self):
+        return {
+            'optimizer': self.optimizer.state_dict() if self.optimizer is not None else None,
+            'scheduler': self.scheduler.state_dict() if self.scheduler is not None else None,
+        }
+
+    def load_optimizer_state(self, path):
+        state = torch.load(path, map_location=self.device)
+        if self.optimizer is not None and state['optimizer'] is not None:
+            self.optimizer.load_state_dict(state['optimizer'])
+        if self.scheduler is not None and state['scheduler'] is not None:
+            self.scheduler.load_state_dict(state['scheduler'])
+
+    @staticmethod
+    def _optimizer_step(model, optimizer):
+        optimizer.step()
+        # the bias matrices of Ipa2ltHead are normalized after each update, StackedIpa2ltHead normalizes in forward
+        if isinstance(model, Ipa2ltHead):
+            model.normalize_bias_matrices()
 
     def _print(self, *args, **kwargs):
 
         print(*args, **kwargs)
 
     def fit(self, epochs, return_f1=False, single_annotator=None, basic_only=False, fix_base=False,
-            pretrained_basic=False, deep_randomization=False, early_stopping_interval=0):
-        model = self._get_model(basic_only=basic_only,
-                                pretrained_basic=pretrained_basic)
+            pretrained_basic=False, deep_randomization=False, early_stopping_interval=0, fused_step=False,
+            start_epoch=0, model=None, resume_path='', total_epochs=None):
+        """
+        Training can be resumed at start_epoch (epochs is the index of the last epoch + 1), either with a model
+        (continuing with the optimizer of this solver if it has one) or from a checkpoint written by save_checkpoint.
+        total_epochs is the length of the lr schedule if training is split into several calls (default: epochs).
+        """
+        continue_optimizer = model is not None and start_epoch > 0 and self.optimizer is not None
+        if model is None:
+            model = self._get_model(basic_only=basic_only,
+                                    pretrained_basic=pretrained_basic)
+            if resume_path != '':
+                model.load_state_dict(torch.load(resume_path, map_location=self.device))
         if single_annotator is not None or basic_only:
             self.annotator_dim = 1
-            optimizer = self.initialize_optimizer(model.parameters())
 
         if self.loss == 'bce':
             criterion = nn.BCELoss()
@@ -138,12 +248,22 @@ class Solver(object):
             criterion = nn.NLLLoss()
         elif self.loss == 'cross':
             criterion = nn.CrossEntropyLoss()
-        if single_annotator is None and not basic_only:
-            if not fix_base:
-                optimizer = self.initialize_optimizer(model.parameters())
-            else:
-                optimizer = self.initialize_optimizer(
-                    model.bias_matrices.parameters())
+        if single_annotator is None and not basic_only and fix_base:
+            parameters = [param for name, param in model.named_parameters() if name.startswith('bias_matrices')]
+        else:
+            parameters = model.parameters()
+        # one optimizer (and scheduler) for the whole fit, so their state survives across batches and annotators
+        if not continue_optimizer:
+            self.optimizer = self.initialize_optimizer(parameters)
+            self.scheduler = self.initialize_scheduler(self.optimizer, total_epochs or epochs)
+            if self.optimizer_state_path != '':
+                self.load_optimizer_state(self.optimizer_state_path)
+            if resume_path != '' and os.path.exists(self._optimizer_state_path(resume_path)):
+                self.load_optimizer_state(self._optimizer_state_path(resume_path))
+        optimizer = self.optimizer
+        if self.pipeline is not None:
+            # data may have changed since the last fit
+            self.pipeline.reset()
 
         loss_history = []
         if early_stopping_interval is not 0:
@@ -155,7 +275,7 @@ class Solver(object):
         if self.verbose:
             self._print(
                 f'learning rate: {self.learning_rate} - batch size: {self.batch_size}')
-        for epoch in range(epochs):
+        for epoch in range(start_epoch, epochs):
             f1 = 0.0
             samples_looked_at = 0.0
 
@@ -167,23 +287,34 @@ class Solver(object):
                     self.dataset.no_annotator_filter()
                     annotators = self.dataset.annotators
 
-                self.dataset.data_shuffle_after_split()
+                # loaders of the data pipeline reshuffle through their sampler
+                if self.pipeline is None:
+                    self.dataset.data_shuffle_after_split()
 
                 # training
                 self.dataset.set_mode('train')
-                train_loader = torch.utils.data.DataLoader(
-                    self.dataset, batch_size=self.batch_size, collate_fn=self.collate_wrapper, shuffle=True)
-                self.fit_epoch_deep_randomization(model, optimizer, criterion, train_loader, epoch, loss_history,
-                                                  annotators=annotators, basic_only=basic_only)
+                train_loader = self._get_loader(shuffle=True)
+                # one forward and backward pass per batch for all annotators at once
+                use_fused_step = fused_step and single_annotator is None and not basic_only
+                if use_fused_step:
+                    self.fit_epoch_fused(model, optimizer, criterion, train_loader, epoch, loss_history,
+                                         annotators=annotators)
+                else:
+                    self.fit_epoch_deep_randomization(model, optimizer, criterion, train_loader, epoch, loss_history,
+                                                      annotators=annotators, basic_only=basic_only)
                 # validation
                 self.dataset.set_mode('validation')
                 if len(self.dataset) is 0:
                     self.dataset.set_mode('train')
-                val_loader = torch.utils.data.DataLoader(
-                    self.dataset, batch_size=self.batch_size, collate_fn=self.collate_wrapper, shuffle=True)
-                val_loss, _, f1 = self.fit_epoch_deep_randomization(model, optimizer, criterion, val_loader, epoch,
-                                                                    loss_history, annotators=annotators,
-                                                                    basic_only=basic_only, mode='validation', return_metrics=return_f1)
+                val_loader = self._get_loader(shuffle=True)
+                if use_fused_step:
+                    val_loss, _, f1 = self.fit_epoch_fused(model, optimizer, criterion, val_loader, epoch, loss_history,
+                                                           annotators=annotators, mode='validation',
+                                                           return_metrics=return_f1)
+                else:
+                    val_loss, _, f1 = self.fit_epoch_deep_randomization(model, optimizer, criterion, val_loader, epoch,
+                                                                        loss_history, annotators=annotators,
+                                                                        basic_only=basic_only, mode='validation', return_metrics=return_f1)
                 if f1 is not None and isinstance(f1, dict):
                     f1_temp = 0.0
                     for ann in self.dataset.annotators:
@@ -215,20 +346,17 @@ class Solver(object):
 
                     # training
                     self.dataset.set_mode('train')
-                    train_loader = torch.utils.data.DataLoader(
-                        self.dataset, batch_size=self.batch_size, collate_fn=self.collate_wrapper)
+                    train_loader = self._get_loader()
                     self.fit_epoch(model, optimizer, criterion, train_loader, annotator, i,
                                    epoch, loss_history, no_annotator_head=no_annotator_head)
 
                     # validation
                     self.dataset.set_mode('validation')
-                    val_loader = torch.utils.data.DataLoader(
-                        self.dataset, batch_size=self.batch_size, collate_fn=self.collate_wrapper)
+                    val_loader = self._get_loader()
                     if return_f1:
                         if len(val_loader) is 0:
                             self.dataset.set_mode('train')
-                            val_loader = torch.utils.data.DataLoader(
-                                self.dataset, batch_size=self.batch_size, collate_fn=self.collate_wrapper)
+                            val_loader = self._get_loader()
                         val_loss, _, f1_ann = self.fit_epoch(model, optimizer, criterion, val_loader, annotator, i,
                                                              epoch, loss_history, mode='validation', return_metrics=True,
                                                              no_annotator_head=no_annotator_head)
@@ -242,6 +370,9 @@ class Solver(object):
                         self.fit_epoch(model, optimizer, criterion, val_loader, annotator, i,
                                        epoch, loss_history, mode='validation', no_annotator_head=no_annotator_head)
 
+            if self.scheduler is not None:
+                self.scheduler.step()
+
             self._save_model(epoch, model, return_f1=return_f1, f1=f1)
 
             # if mean loss doesn't change over several epochs, stop early with training
@@ -258,6 +389,8 @@ class Solver(object):
                     if mean_loss_interval > stop_margins[0] and mean_loss_interval < stop_margins[1]:
                         self._print(f'Stopping early at epoch {epoch} with loss {mean_loss_interval}')
                         self._save_model(epoch, model, return_f1=return_f1, f1=f1, early_stopping=True)
+                        self.checkpoint_writer.close()
+                        self.metrics_sink.flush()
                         if return_f1:
                             return model, f1
                         else:
@@ -265,9 +398,11 @@ class Solver(object):
 
         if self.verbose:
             self._print('Finished Training' + 20 * ' ')
-            self._print('sum of first 10 losses: ', sum(loss_history[0:10]))
-            self._print('sum of last  10 losses: ', sum(loss_history[-10:]))
+            self._print('sum of first 10 losses: ', float(sum(loss_history[0:10])))
+            self._print('sum of last  10 losses: ', float(sum(loss_history[-10:])))
 
+        self.checkpoint_writer.close()
+        self.metrics_sink.flush()
         if return_f1:
             return model, f1
 
@@ -277,11 +412,7 @@ class Solver(object):
                   return_metrics=False, no_annotator_head=False):
         if no_annotator_head:
             annotator_idx = None
-        mean_loss = 0.0
-        mean_accuracy = 0.0
-        mean_precision = 0.0
-        mean_recall = 0.0
-        mean_f1 = 0.0
+        metrics = StreamingConfusionMatrix(1, self.label_dim, device=self.device)
         len_data_loader = len(data_loader)
         for i, data in enumerate(data_loader, 1):
             # Prepare inputs to be passed to the model
@@ -293,10 +424,9 @@ class Solver(object):
 
             # Generate predictions
             if annotator_idx is not None:
-                outputs = model(inputs)[annotator_idx]
+                outputs_pseudo_labels = model(inputs)
+                outputs = outputs_pseudo_labels[annotator_idx]
                 if len(pseudo_labels) is not 0:
-                    outputs_pseudo_labels = model(inputs)
-                    opt = self.initialize_optimizer(model.parameters())
                     if isinstance(pseudo_labels, list):
                         pseudo_annotators = set(
                             [ann for sample in pseudo_labels for ann in list(sample.keys())])
@@ -312,53 +442,54 @@ class Solver(object):
             # Compute Loss:
             loss = criterion(outputs.float(), labels)
 
-            # performance measures of the batch
-            predictions = outputs.argmax(dim=1)
-            accuracy, precision, recall, f1 = self.performance_measures(
-                predictions, labels, self.averaging_method)
-
-            # statistics for logging
-            current_batch_size = inputs.shape[0]
-            divisor = (i - 1) * self.batch_size + current_batch_size
-            mean_loss = ((i - 1) * self.batch_size * mean_loss +
-                         loss.item() * current_batch_size) / divisor
-            mean_accuracy = (mean_accuracy * self.batch_size * (i - 1) +
-                             accuracy.item() * current_batch_size) / divisor
-            mean_precision = (mean_precision * self.batch_size *
-                              (i - 1) + precision.item() * current_batch_size) / divisor
-            mean_recall = (mean_recall * self.batch_size * (i - 1) +
-                           recall.item() * current_batch_size) / divisor
-            mean_f1 = (mean_f1 * self.batch_size * (i - 1) +
-                       f1.item() * current_batch_size) / divisor
-            loss_history.append(loss.item())
+            # statistics for logging, accumulated on device
+            metrics.update(outputs.argmax(dim=1), labels)
+            metrics.update_loss(loss, inputs.shape[0])
+            loss_history.append(loss.detach())
 
             if mode is 'train':
                 # Update gradients
                 if annotator_idx is not None and len(pseudo_labels) is not 0:
                     final_loss = loss
                     for pseudo_loss in losses:
-                        final_loss += pseudo_loss
+                        final_loss = final_loss + pseudo_loss
                     final_loss.backward()
                 else:
                     loss.backward()
 
                 # Optimization step
-                opt.step()
-
-            if self.writer is not None:
-                self.writer.add_scalar(
-                    f'Loss/Annotator {annotator}/{mode}', mean_loss, epoch)
-                self.writer.add_scalar(
-                    f'Accuracy/Annotator {annotator}/{mode}', mean_accuracy, epoch)
-                self.writer.add_scalar(
-                    f'Precision/Annotator {annotator}/{mode}', mean_precision, epoch)
-                self.writer.add_scalar(
-                    f'Recall/Annotator {annotator}/{mode}', mean_recall, epoch)
-                self.writer.add_scalar(
-                    f'F1 score/Annotator {annotator}/{mode}', mean_f1, epoch)
+                self._optimizer_step(model, opt)
 
+        epoch_metrics = self._log_metrics(metrics, [annotator], mode, epoch)[annotator]
         if return_metrics:
-            return mean_loss, mean_accuracy, mean_f1
+            return epoch_metrics['loss'], epoch_metrics['accuracy'], epoch_metrics['f1']
+
+    def _log_metrics(self, metrics, annotators, mode, epoch):
+        """Derive the epoch metrics of every annotator from the accumulated confusion matrices and log them"""
+        accuracy, precision, recall, f1 = [measure.tolist() for measure in metrics.measures(self.averaging_method)]
+        mean_loss = metrics.mean_loss().tolist()
+        samples = metrics.samples().tolist()
+
+        epoch_metrics = {}
+        for idx, annotator in enumerate(annotators):
+            epoch_metrics[annotator] = {'loss': mean_loss[idx], 'accuracy': accuracy[idx], 'precision': precision[idx],
+                                        'recall': recall[idx], 'f1': f1[idx], 'samples': samples[idx]}
+            if samples[idx] != 0:
+                self.metrics_sink.add_scalar(
+                    f'Loss/Annotator {annotator}/{mode}', mean_loss[idx], epoch)
+                self.metrics_sink.add_scalar(
+                    f'Accuracy/Annotator {annotator}/{mode}', accuracy[idx], epoch)
+                self.metrics_sink.add_scalar(
+                    f'Precision/Annotator {annotator}/{mode}', precision[idx], epoch)
+                self.metrics_sink.add_scalar(
+                    f'Recall/Annotator {annotator}/{mode}', recall[idx], epoch)
+                self.metrics_sink.add_scalar(
+                    f'F1 score/Annotator {annotator}/{mode}', f1[idx], epoch)
+        return epoch_metrics
+
+    @staticmethod
+    def _score_dicts(epoch_metrics, measure):
+        return {ann: {'score': values[measure], 'samples': values['samples']} for ann, values in epoch_metrics.items()}
 
     def fit_epoch_deep_randomization(self, model, optimizer, criterion, data_loader, epoch, loss_history, annotators=[], mode='train',
                                      return_metrics=False, basic_only=False):
@@ -374,20 +505,14 @@ class Solver(object):
             if len(annotators) is 1:
                 single_annotator = annotators[0]
             annotators = []
-            mean_loss = 0.0
-            mean_accuracy = 0.0
-            mean_precision = 0.0
-            mean_recall = 0.0
-            mean_f1 = 0.0
+            metrics = StreamingConfusionMatrix(1, self.label_dim, device=self.device)
         else:
             if len(annotators) == 0:
                 print('ERROR - Please provide annotators in correct order!')
                 return
-            mean_loss = {ann: {'score': 0.0, 'samples': 0.0} for ann in annotators}
-            mean_accuracy = {ann: {'score': 0.0, 'samples': 0.0} for ann in annotators}
-            mean_precision = {ann: {'score': 0.0, 'samples': 0.0} for ann in annotators}
-            mean_recall = {ann: {'score': 0.0, 'samples': 0.0} for ann in annotators}
-            mean_f1 = {ann: {'score': 0.0, 'samples': 0.0} for ann in annotators}
+            metrics = StreamingConfusionMatrix(len(annotators), self.label_dim, device=self.device)
+        # index of every annotator in the batches
+        dataset_annotator_idx = [self.dataset.annotator_index(annotator) for annotator in annotators]
 
         if self.loss == 'bce':
             one_hot = torch.eye(self.label_dim).to(self.device)
@@ -400,9 +525,12 @@ class Solver(object):
 
             # Generate predictions
             losses = {}
+            pseudo_annotators = set()
             if len(pseudo_labels) is not 0:
                 pseudo_annotators = set(
                     [ann for sample in pseudo_labels for ann in list(sample.keys())])
+            # annotator indices of the samples in the batch, e.g. a single one for annotator homogeneous batches
+            batch_annotators = set(data.annotator_idx.tolist())
 
             for annotator_idx, annotator in enumerate(annotators):
                 self._print(
@@ -424,24 +552,19 @@ class Solver(object):
                 #         f.write(bias_out)
                 #     time.sleep(1)
 
+                in_batch = dataset_annotator_idx[annotator_idx] in batch_annotators
+                if not in_batch and annotator not in pseudo_annotators:
+                    continue
+
                 outputs = model(inputs)
                 outputs_annotator = outputs[annotator_idx]
                 loss_annotations = None
 
-                optimizer = self.initialize_optimizer(model.parameters())
-
-                if annotator in set(annotations):
-                    mask_labels = torch.tensor(
-                        [ann == annotator for ann in annotations]).to(device=self.device)
-                    mask_outputs = torch.tensor(
-                        [[ann == annotator] * self.label_dim for ann in annotations]).to(device=self.device)
-                    labels_annotations = torch.masked_select(
-                        labels, mask_labels)
+                if in_batch:
+                    mask_labels = data.annotator_idx == dataset_annotator_idx[annotator_idx]
+                    labels_annotations = labels[mask_labels]
                     labels_annotations_for_performance = labels_annotations.detach().clone()
-                    outputs_dim = (
-                        mask_labels[mask_labels].shape[0], outputs_annotator.shape[1])
-                    outputs_annotations = torch.masked_select(
-                        outputs_annotator, mask_outputs).reshape(outputs_dim)
+                    outputs_annotations = outputs_annotator[mask_labels]
                     if self.loss == 'bce':
                         # one hot encode for bce loss
                         labels_annotations = one_hot[labels_annotations]
@@ -476,47 +599,12 @@ class Solver(object):
                     elif loss_pseudo_annotations is not None and loss_annotations is None:
                         loss = loss_pseudo_annotations
 
-                    if annotator in set(annotations):
+                    if in_batch:
                         # record performance for this annotator (discard pseudo annotations)
-                        predictions = outputs_annotations.argmax(dim=1)
-                        accuracy, precision, recall, f1 = self.performance_measures(
-                            predictions, labels_annotations_for_performance, self.averaging_method)
-
-                        # statistics for logging
-                        current_batch_size = predictions.shape[0]
-                        mean_loss[annotator]['score'] = (mean_loss[annotator]['score'] * mean_loss[annotator]['samples'] +
-                                                         loss.item() * current_batch_size) / (mean_loss[annotator]['samples'] + current_batch_size)
-                        mean_accuracy[annotator]['score'] = (mean_accuracy[annotator]['score'] * mean_accuracy[annotator]['samples'] +
-                                                             accuracy.item() * current_batch_size) / (mean_accuracy[annotator]['samples']
-                                                                                                      + current_batch_size)
-                        mean_precision[annotator]['score'] = (mean_precision[annotator]['score'] * mean_precision[annotator]['samples'] +
-                                                              precision.item() * current_batch_size) / (mean_precision[annotator]['samples']
-                                                                                                        + current_batch_size)
-                        mean_recall[annotator]['score'] = (mean_recall[annotator]['score'] * mean_recall[annotator]['samples']
-                                                           + recall.item() * current_batch_size) / (mean_recall[annotator]['samples']
-                                                                                                    + current_batch_size)
-                        mean_f1[annotator]['score'] = (
-                            mean_f1[annotator]['score'] * mean_f1[annotator]['samples'] + f1.item() * current_batch_size) \
-                            / (mean_f1[annotator]['samples'] + current_batch_size)
-                        # update sample counter for current annotator
-                        mean_loss[annotator]['samples'] += current_batch_size
-                        mean_accuracy[annotator]['samples'] += current_batch_size
-                        mean_precision[annotator]['samples'] += current_batch_size
-                        mean_recall[annotator]['samples'] += current_batch_size
-                        mean_f1[annotator]['samples'] += current_batch_size
-                        loss_history.append(loss.item())
-
-                        if self.writer is not None:
-                            self.writer.add_scalar(
-                                f'Loss/Annotator {annotator}/{mode}', mean_loss[annotator]['score'], epoch)
-                            self.writer.add_scalar(
-                                f'Accuracy/Annotator {annotator}/{mode}', mean_accuracy[annotator]['score'], epoch)
-                            self.writer.add_scalar(
-                                f'Precision/Annotator {annotator}/{mode}', mean_precision[annotator]['score'], epoch)
-                            self.writer.add_scalar(
-                                f'Recall/Annotator {annotator}/{mode}', mean_recall[annotator]['score'], epoch)
-                            self.writer.add_scalar(
-                                f'F1 score/Annotator {annotator}/{mode}', mean_f1[annotator]['score'], epoch)
+                        metrics.update(outputs_annotations.argmax(dim=1), labels_annotations_for_performance,
+                                       annotator_idx)
+                        metrics.update_loss(loss, labels_annotations_for_performance.shape[0], annotator_idx)
+                        loss_history.append(loss.detach())
 
                     if mode is 'train':
                         # Update gradients
@@ -532,7 +620,7 @@ class Solver(object):
                         # Optimization step
                         # print(f'These are the parameters in optimizer: {optimizer}')
                         # print(f'Bias matrix weights before: {model.bias_matrices[annotator_idx].weight}')
-                        optimizer.step()
+                        self._optimizer_step(model, optimizer)
                         # print(f'Bias matrix weights after: {model.bias_matrices[annotator_idx].weight}')
                         # if annotator == 'male':
                         #     self.optimizer, self.model = optimizer, model
@@ -576,25 +664,10 @@ class Solver(object):
                 # Compute Loss:
                 loss = criterion(outputs.float(), labels)
 
-                # performance measures of the batch
-                predictions = outputs.argmax(dim=1)
-                accuracy, precision, recall, f1 = self.performance_measures(
-                    predictions, labels_for_performance, self.averaging_method)
-
-                # statistics for logging
-                current_batch_size = inputs.shape[0]
-                divisor = (i - 1) * self.batch_size + current_batch_size
-                mean_loss = ((i - 1) * self.batch_size * mean_loss +
-                             loss.item() * current_batch_size) / divisor
-                mean_accuracy = (mean_accuracy * self.batch_size * (i - 1) +
-                                 accuracy.item() * current_batch_size) / divisor
-                mean_precision = (mean_precision * self.batch_size *
-                                  (i - 1) + precision.item() * current_batch_size) / divisor
-                mean_recall = (mean_recall * self.batch_size * (i - 1) +
-                               recall.item() * current_batch_size) / divisor
-                mean_f1 = (mean_f1 * self.batch_size * (i - 1) +
-                           f1.item() * current_batch_size) / divisor
-                loss_history.append(loss.item())
+                # statistics for logging, accumulated on device
+                metrics.update(outputs.argmax(dim=1), labels_for_performance)
+                metrics.update_loss(loss, inputs.shape[0])
+                loss_history.append(loss.detach())
 
                 if mode is 'train':
                     # Update gradients
@@ -609,219 +682,245 @@ class Solver(object):
                             loss_pseudo.backward(retain_graph=retain_graph)
 
                     # Optimization step
-                    optimizer.step()
-
-                if self.writer is not None:
-                    self.writer.add_scalar(
-                        f'Loss/Annotator {annotator}/{mode}', mean_loss, epoch)
-                    self.writer.add_scalar(
-                        f'Accuracy/Annotator {annotator}/{mode}', mean_accuracy, epoch)
-                    self.writer.add_scalar(
-                        f'Precision/Annotator {annotator}/{mode}', mean_precision, epoch)
-                    self.writer.add_scalar(
-                        f'Recall/Annotator {annotator}/{mode}', mean_recall, epoch)
-                    self.writer.add_scalar(
-                        f'F1 score/Annotator {annotator}/{mode}', mean_f1, epoch)
+                    self._optimizer_step(model, optimizer)
+
+        if basic_only:
+            annotator = 'all' if single_annotator is None else single_annotator
+            epoch_metrics = self._log_metrics(metrics, [annotator], mode, epoch)[annotator]
+            if return_metrics:
+                return epoch_metrics['loss'], epoch_metrics['accuracy'], epoch_metrics['f1']
+        else:
+            epoch_metrics = self._log_metrics(metrics, annotators, mode, epoch)
+            if return_metrics:
+                return (self._score_dicts(epoch_metrics, 'loss'), self._score_dicts(epoch_metrics, 'accuracy'),
+                        self._score_dicts(epoch_metrics, 'f1'))
+
+    def fit_epoch_fused(self, model, optimizer, criterion, data_loader, epoch, loss_history, annotators=[], mode='train',
+                        return_metrics=False):
+        """
+            single pass version of fit_epoch_deep_randomization for models with annotator heads: the model
+            is run once per batch, each sample is matched with the output of its own annotator and of its
+            pseudo annotators by index, and the summed per annotator losses are optimized with one backward pass
+        """
+        if len(annotators) == 0:
+            print('ERROR - Please provide annotators in correct order!')
+            return
+        annotator_index = {ann: idx for idx, ann in enumerate(annotators)}
+        annotator_dim = len(annotators)
+        # head of every annotator index of the dataset, -1 for annotators without a head (e.g. 'custom')
+        dataset_annotator_idx = [self.dataset.annotator_index(ann) for ann in annotators]
+        head_index = torch.full((max(dataset_annotator_idx) + 1,), -1, dtype=torch.long, device=self.device)
+        head_index[dataset_annotator_idx] = torch.arange(annotator_dim, device=self.device)
+        metrics = StreamingConfusionMatrix(annotator_dim, self.label_dim, device=self.device)
+
+        # per sample losses are averaged per annotator by hand
+        sample_criterion = type(criterion)(reduction='none')
+        if self.loss == 'bce':
+            one_hot = torch.eye(self.label_dim).to(self.device)
+
+        def annotator_means(outputs, targets, annotator_idx):
+            if self.loss == 'bce':
+                sample_losses = sample_criterion(outputs.float(), one_hot[targets]).mean(dim=1)
+            else:
+                sample_losses = sample_criterion(outputs.float(), targets)
+            sums = torch.zeros(annotator_dim, device=self.device).index_add_(0, annotator_idx, sample_losses)
+            counts = torch.bincount(annotator_idx, minlength=annotator_dim)
+            return sums / counts.clamp(min=1)
 
+        # Training loop
+        len_data_loader = len(data_loader)
+        for i, data in enumerate(data_loader, 1):
+            self._print(f'Epoch {epoch}: Step {i} / {len_data_loader}' + 10 * ' ', end='\r')
+            inputs, labels, pseudo_labels, annotations = data.input, data.target, data.pseudo_targets, data.annotations
+            optimizer.zero_grad()
+
+            outputs = model(inputs)
+            if isinstance(outputs, list):
+                outputs = torch.stack(outputs)
+
+            # output of every sample's own annotator [batch_size, label_dim], samples of annotators without a head
+            # are left out
+            in_head_index = data.annotator_idx < len(head_index)
+            annotator_idx = torch.where(in_head_index, head_index[data.annotator_idx.clamp(max=len(head_index) - 1)], -1)
+            has_head = annotator_idx >= 0
+            annotator_idx = annotator_idx[has_head]
+            batch_idx = torch.arange(len(annotations), device=self.device)[has_head]
+            labels = labels[has_head]
+            outputs_annotations = outputs[annotator_idx, batch_idx]
+            loss_annotations = annotator_means(outputs_annotations, labels, annotator_idx)
+
+            # pseudo labels of all annotators in one matrix [annotator_dim, batch_size], -1 meaning no pseudo label
+            loss_pseudo_annotations = torch.zeros(annotator_dim, device=self.device)
+            pseudo_matrix = np.full((annotator_dim, len(annotations)), -1, dtype=np.int64)
+            for j, sample in enumerate(pseudo_labels):
+                for ann, pseudo_label in sample.items():
+                    if ann in annotator_index:
+                        pseudo_matrix[annotator_index[ann], j] = int(pseudo_label)
+            pseudo_ann_idx, pseudo_batch_idx = np.nonzero(pseudo_matrix >= 0)
+            if len(pseudo_ann_idx) != 0:
+                pseudo_targets = torch.from_numpy(pseudo_matrix[pseudo_ann_idx, pseudo_batch_idx]).to(device=self.device)
+                pseudo_ann_idx = torch.from_numpy(pseudo_ann_idx).to(device=self.device)
+                pseudo_batch_idx = torch.from_numpy(pseudo_batch_idx).to(device=self.device)
+                loss_pseudo_annotations = annotator_means(outputs[pseudo_ann_idx, pseudo_batch_idx], pseudo_targets,
+                                                          pseudo_ann_idx)
+
+            losses = loss_annotations + loss_pseudo_annotations
+            if mode == 'train' and losses.requires_grad:
+                losses.sum().backward()
+                self._optimizer_step(model, optimizer)
+
+            # record performance for each annotator (discard pseudo annotations), accumulated on device
+            metrics.update(outputs_annotations.argmax(dim=1), labels, annotator_idx)
+            metrics.update_loss(losses, torch.bincount(annotator_idx, minlength=annotator_dim))
+            loss_history.append(losses.detach().sum())
+
+        epoch_metrics = self._log_metrics(metrics, annotators, mode, epoch)
         if return_metrics:
-            return mean_loss, mean_accuracy, mean_f1
+            return (self._score_dicts(epoch_metrics, 'loss'), self._score_dicts(epoch_metrics, 'accuracy'),
+                    self._score_dicts(epoch_metrics, 'f1'))
 
-    def evaluate_model(self, output_file_path, labels=None, mode='train', pretrained_basic_path='', basic_only=False):
+    def evaluate_model(self, output_file_path, labels=None, mode='train', pretrained_basic_path='', basic_only=False,
+                       samples_path='', batch_size=1024):
+        """
+        Evaluate the model on the data of every annotator in batches and write a report to output_file_path.
+        The outputs of all annotator heads for each sample are streamed to samples_path (.csv or .jsonl,
+        by default next to the report). Returns the summary the report is formatted from.
+        """
         model = self._get_model(basic_only=basic_only)
+        model.eval()
 
         # load pretrained model for comparison
+        pretrained_model = None
         if pretrained_basic_path != '':
             pretrained_model = BasicNetwork(
-                self.embedding_dim, self.label_dim, use_softmax=self.use_softmax)
+                self.embedding_dim, self.label_dim, use_softmax=self.use_softmax,
+                embedding_matrix=self.dataset.embedding_matrix)
             pretrained_model.load_state_dict(torch.load(pretrained_basic_path))
             pretrained_model.to(self.device)
 
         # also document loss
         if self.loss == 'bce':
             one_hot = torch.eye(self.label_dim).to(self.device)
-            criterion = nn.BCELoss()
+            criterion = nn.BCELoss(reduction='none')
         elif self.loss == 'nll' or self.loss == 'nll_log':
-            criterion = nn.NLLLoss()
+            criterion = nn.NLLLoss(reduction='none')
         elif self.loss == 'cross':
-            criterion = nn.CrossEntropyLoss()
-        mean_loss = 0.0
-        annotators_mean_losses = {}
+            criterion = nn.CrossEntropyLoss(reduction='none')
 
-        # write annotation bias matrices into log file
-        import sys
-        original_stdout = sys.stdout
-        with open(output_file_path, 'w') as f:
-            sys.stdout = f
-            self.dataset.set_mode(mode)
-            out_text = ''
-            acc_out = ''
-            bias_conf_out = 'Annotation bias and confusion matrices\n\n'
-            overall_correct = 0
-            overall_len = 0
-            if pretrained_basic_path != '':
-                pretrained_correct = 0
-            for ann_idx, annotator in enumerate(self.dataset.annotators):
-                correct = {ann: 0 for ann in self.dataset.annotators}
-
-                different_answers = 0
-                different_answers_idx = []
-
-                annotators_mean_losses[annotator] = 0.0
+        annotators = self.dataset.annotators
+        summary = {
+            'annotators': annotators, 'basic_only': basic_only, 'samples': {}, 'overall_correct': 0,
+            'overall_len': 0, 'pretrained_correct': 0 if pretrained_model is not None else None,
+            'mean_losses': {}, 'confusion_matrices': {}, 'bias_matrices': {}, 'correct': {},
+            'different_answers': {}, 'different_answers_idx': {}, 'samples_path': None,
+        }
 
-                confusion_matrix = np.zeros((self.label_dim, self.label_dim))
+        sink = None
+        if not basic_only:
+            if samples_path == '':
+                samples_path = f'{os.path.splitext(output_file_path)[0]}_samples.csv'
+            fields = ['sample', 'annotator', 'label'] + [f'latent_truth_{j}' for j in range(self.label_dim)] + \
+                [f'{ann}_{j}' for ann in annotators for j in range(self.label_dim)]
+            sink = get_sample_sink(samples_path, fields)
+            summary['samples_path'] = samples_path
 
-                self.dataset.set_annotator_filter(annotator)
-                # batch_size needs to be 1
-                data_loader = torch.utils.data.DataLoader(
-                    self.dataset, batch_size=1, collate_fn=self.collate_wrapper)
+        self.dataset.set_mode(mode)
+        try:
+            with torch.inference_mode():
+                for ann_idx, annotator in enumerate(annotators):
+                    self.dataset.set_annotator_filter(annotator)
+                    data_loader = torch.utils.data.DataLoader(
+                        self.dataset, batch_size=batch_size, collate_fn=self.collate_wrapper)
+
+                    # statistics are accumulated on device and fetched once per annotator
+                    loss_sum = torch.zeros((), device=self.device)
+                    confusion_matrix = torch.zeros(self.label_dim * self.label_dim, dtype=torch.long,
+                                                   device=self.device)
+                    correct = torch.zeros(len(annotators), dtype=torch.long, device=self.device)
+                    overall_correct = torch.zeros((), dtype=torch.long, device=self.device)
+                    pretrained_correct = torch.zeros((), dtype=torch.long, device=self.device)
+                    different_answers = []
+
+                    sample_idx = 1
+                    for data in data_loader:
+                        inp, label = data.input, data.target
+
+                        # Generate predictions
+                        output = model(inp)
+                        if pretrained_model is not None:
+                            pretrained_correct += (pretrained_model(inp).argmax(dim=1) == label).sum()
 
-                for sample_idx, data in enumerate(data_loader, 1):
-                    # Prepare inputs to be passed to the model
-                    inp, label = data.input, data.target
+                        if basic_only:
+                            overall_correct += (output.argmax(dim=1) == label).sum()
+                            sample_idx += label.shape[0]
+                            continue
 
-                    # Generate predictions
-                    if basic_only:
-                        latent_truth = model(inp)
-                    else:
                         latent_truth = model.basic_network(inp)
-                    output = model(inp)
-                    if pretrained_basic_path != '':
-                        pretrained_output = pretrained_model(inp)
-
-                    # calculate loss
-                    if self.loss == 'bce':
-                        # one hot encode for bce loss
-                        label = one_hot[label]
+                        if isinstance(output, list):
+                            output = torch.stack(output)
 
+                        # calculate loss
+                        if self.loss == 'bce':
+                            loss_sum += criterion(output[ann_idx].float(), one_hot[label]).mean(dim=1).sum()
+                        else:
+                            loss_sum += criterion(output[ann_idx].float(), label).sum()
+
+                        # generate confusion matrix of labels and latent truth
+                        confusion_matrix += torch.bincount(label * self.label_dim + latent_truth.argmax(dim=1),
+                                                           minlength=self.label_dim * self.label_dim)
+
+                        # compare the prediction of each annotator head with the label
+                        predictions = output.argmax(dim=2)
+                        correct += (predictions == label).sum(dim=1)
+                        overall_correct += (predictions[ann_idx] == label).sum()
+                        different_answers.append((predictions != predictions[0]).any(dim=0))
+
+                        # stream outputs for each sample
+                        batch_len = label.shape[0]
+                        rows = torch.cat([label.unsqueeze(1).float(), latent_truth,
+                                          output.permute(1, 0, 2).reshape(batch_len, -1)], dim=1).tolist()
+                        sink.write_rows([[sample_idx + i, annotator] + [int(row[0])] + row[1:]
+                                         for i, row in enumerate(rows)])
+                        sample_idx += batch_len
+
+                    samples = len(self.dataset)
+                    summary['samples'][annotator] = samples
+                    summary['overall_len'] += samples
+                    summary['overall_correct'] += overall_correct.item()
+                    if pretrained_model is not None:
+                        summary['pretrained_correct'] += pretrained_correct.item()
                     if not basic_only:
-                        annotators_mean_losses[annotator] += criterion(
-                            output[ann_idx].float(), label).item()
-
-                        # generate confusion matrix
-                        confusion_matrix[label.cpu().numpy().item(0)][latent_truth.argmax(
-                            dim=1).cpu().detach().numpy().item(0)] += 1.0
-
-                        # print input/output
-                        out_text += f'Point {sample_idx} - Label by {annotator}: {label.cpu().numpy()} - Latent truth {latent_truth.cpu().detach().numpy()}'
-                        predictions = {}
-                        for idx, ann in enumerate(self.dataset.annotators):
-                            out_text += f' - Annotator {ann} {output[idx].cpu().detach().numpy()}'
-                            predictions[ann] = [output[idx].argmax(
-                                dim=1), output[idx].max(dim=1)]
-
-                        # compare the prediction with the label for each annotator
-                        for idx, ann in enumerate(self.dataset.annotators):
-                            if predictions[ann][0] == label:
-                                # annotator_highest_pred = max(filtered_preds, key=filtered_preds.get)
-                                correct[ann] += 1
-
-                        # compare the prediction with the label for the annotator that created the label
-                        if predictions[annotator][0] == label:
-                            overall_correct += 1
-
-                        predictions_set = set([predictions[ann][0].cpu().detach(
-                        ).numpy().item(0) for ann in self.dataset.annotators])
-                        if len(predictions_set) is not 1:
-                            different_answers += 1
-                            different_answers_idx.append(sample_idx)
+                        summary['mean_losses'][annotator] = loss_sum.item() / samples if samples != 0 else 0.0
+                        summary['confusion_matrices'][annotator] = normalize_rows(
+                            confusion_matrix.view(self.label_dim, self.label_dim).cpu().numpy())
+                        summary['bias_matrices'][annotator] = model.get_bias_matrix(ann_idx).cpu().detach().numpy()
+                        summary['correct'][annotator] = dict(zip(annotators, correct.tolist()))
+                        different_answers_idx = []
+                        if len(different_answers) != 0:
+                            different_answers_idx = (torch.cat(different_answers).nonzero().flatten() + 1).tolist()
+                        summary['different_answers'][annotator] = len(different_answers_idx)
+                        summary['different_answers_idx'][annotator] = different_answers_idx[:5]
+                self.dataset.no_annotator_filter()
+        except BaseException:
+            # do not leave a truncated samples file behind
+            if sink is not None:
+                sink.close()
+                os.remove(samples_path)
+                sink = None
+            raise
+        finally:
+            if sink is not None:
+                sink.close()
 
-                    else:
-                        if output.argmax(dim=1) == label:
-                            overall_correct += 1
-
-                    # compare the prediction with the label for the pretrained model
-                    if pretrained_basic_path != '':
-                        if pretrained_output.argmax(dim=1) == label:
-                            pretrained_correct += 1
-
-                    out_text += '\n'
-
-                if not basic_only:
-                    if len(self.dataset) != 0:
-                        annotators_mean_losses[annotator] /= len(self.dataset)
-                    mean_loss += annotators_mean_losses[annotator]
-
-                    for row in confusion_matrix:
-                        if row.sum() != 0.0:
-                            row /= row.sum()
-
-                    bias_conf_out += f'Annotator {annotator}\n'
-                    bias_conf_out += f'Output\\LatentTruth'
-                    if labels is not None:
-                        for label in labels:
-                            bias_conf_out += '\t' * 3 + f'{label}'
-                        bias_conf_out += '\t' * 5 + f'Label\\LatentTruth'
-                        for label in labels:
-                            bias_conf_out += '\t' * 3 + f'{label}'
-                        bias_conf_out += '\n'
-                        for j, label in enumerate(labels):
-                            bias_conf_out += f'{label}' + ' ' * (15 - len(label))
-                            for k, label_2 in enumerate(labels):
-                                bias_conf_out += '\t' * 3 + \
-                                    f'{model.bias_matrices[ann_idx].weight[j][k].cpu().detach().numpy(): .4f}'
-                            bias_conf_out += '\t' * 5
-                            bias_conf_out += f'{label}' + ' ' * (15 - len(label))
-                            for k, label_2 in enumerate(labels):
-                                bias_conf_out += '\t' * 3 + \
-                                    f'{confusion_matrix[j][k]: .4f}'
-                            bias_conf_out += '\n'
-                        bias_conf_out += '\n'
-                    else:
-                        bias_conf_out += f'{model.bias_matrices[ann_idx].weight.cpu().detach().numpy()}\n\n'
-
-                overall_len += len(self.dataset)
-
-                # Document correct predictions
-                all_same_accuracies = set([correct[ann]
-                                           for ann in self.dataset.annotators])
-                acc_out += '-' * 25 + \
-                    f'   Annotator {annotator}   ' + '-' * 25 + '\n'
-                acc_out += f'Different answers given by bias matrices {different_answers} / {len(self.dataset)} times\n'
-                acc_out += f'Different answers at points: {different_answers_idx[:min(5, len(different_answers_idx))]}\n'
-                acc_out += f'Accuracies of samples labeled by {annotator}:'
-                # ' has {len(all_same_accuracies)} '
-                # if len(all_same_accuracies) is 1:
-                #     acc_out += 'answer\n'
-                # else:
-                #     acc_out += 'different answers\n'
-                acc_out += '\n'
-                for ann in self.dataset.annotators:
-                    acc_out += f'Annotator {ann}: {correct[ann]} / {len(self.dataset)}     '
-                acc_out += '\n\n'
-
-            # Document Loss
-            mean_loss /= len(self.dataset.annotators)
-            loss_out = f'Mean Loss (over annotators & samples): {mean_loss:.5f}\n'
-            loss_out += f'Mean Loss for each annotator (over samples):\n'
-            for ann in self.dataset.annotators:
-                loss_out += f'Annotator {ann}: {annotators_mean_losses[ann]:.5f}        '
-            loss_out += '\n\n\n'
-
-            # Document overall accuracy
-            overall_acc_out = 'Overall accuracies\n\n'
-            overall_accuracy = overall_correct / overall_len
-            overall_acc_out += f'Accuracy after extensive training'
-            if not basic_only:
-                overall_acc_out += ' with bias matrices'
-            overall_acc_out += f': {overall_correct} / {overall_len} or as percentage: {overall_accuracy:.5f}\n'
-            if pretrained_basic_path != '':
-                pretrained_accuracy = pretrained_correct / overall_len
-                overall_acc_out += f'Accuracy with pretrained model: {pretrained_correct} / {overall_len} ' + \
-                    f'or as percentage: {pretrained_accuracy:.5f}\n\n'
-            else:
-                overall_acc_out += '\n\n'
+        if not basic_only:
+            summary['mean_loss'] = sum(summary['mean_losses'].values()) / len(annotators)
 
-            print(overall_acc_out)
-            if not basic_only:
-                print(loss_out)
-                print(bias_conf_out)
-                print(acc_out)
-                print('\n' * 30)
-                print(out_text)
-            sys.stdout = original_stdout
+        with open(output_file_path, 'w') as f:
+            f.write(format_evaluation_report(summary, labels))
+        return summary
 
     def evaluate_model_simple(self, labeling_scheme='single', pretrained_basic_path='', basic_only=False, mode='test',
-                              return_metrics=True, averaging_method='macro'):
+                              return_metrics=True, averaging_method='macro', batch_size=1024):
         """
         Calculate accuracy and f1 score for model and pretrained model.
         Apply Dawid-Skene or Majority Voting to get ground truth labels for evaluation.
@@ -838,9 +937,11 @@ class Solver(object):
         self.dataset.set_mode(mode)
 
         # load pretrained model for comparison
+        pretrained_model = None
         if pretrained_basic_path != '':
             pretrained_model = BasicNetwork(
-                self.embedding_dim, self.label_dim, use_softmax=self.use_softmax)
+                self.embedding_dim, self.label_dim, use_softmax=self.use_softmax,
+                embedding_matrix=self.dataset.embedding_matrix)
             pretrained_model.load_state_dict(torch.load(pretrained_basic_path))
             pretrained_model.to(self.device)
 
@@ -852,82 +953,38 @@ class Solver(object):
                 # only consider basic classifier of LTNet
                 model = model.basic_network
 
-            # batch_size needs to be 1
-            data_loader = torch.utils.data.DataLoader(
-                self.dataset, batch_size=1, collate_fn=self.collate_wrapper)
-
             # to calculate the f1 score, we need all predictions and labels by one annotator
-            predictions = []
-            pretrained_predictions = []
-            labels = []
-
-            for sample_idx, data in enumerate(data_loader, 1):
-                # Prepare inputs to be passed to the model
-                inp, label = data.input, data.target
-
-                # Generate predictions
-                output = model(inp)
-                if pretrained_basic_path != '':
-                    pretrained_output = pretrained_model(inp)
-
-                predictions.append(output.argmax(dim=1).item())
-                labels.append(label.item())
-
-                # document the prediction of the pretrained model
-                if pretrained_basic_path != '':
-                    pretrained_predictions.append(pretrained_output.argmax(dim=1))
+            labels, predictions = self._predict([model, pretrained_model], batch_size=batch_size)
 
             # calculate metrics for annotator
-            accuracy, _, _, f1 = self.performance_measures(torch.tensor(predictions), torch.tensor(labels), averaging_method=averaging_method)
-            # print(f'DEBUG\nAccuracy {accuracy}   -   F1 {f1}\nPredictions+Labels\n{[[x, y] for x, y in zip(labels, predictions)]}')
+            accuracy, _, _, f1 = self.performance_measures(predictions[0], labels, averaging_method=averaging_method)
             if pretrained_basic_path != '':
-                pretrained_accuracy, _, _, pretrained_f1 = self.performance_measures(torch.tensor(
-                    pretrained_predictions), torch.tensor(labels), averaging_method=averaging_method)
+                pretrained_accuracy, _, _, pretrained_f1 = self.performance_measures(
+                    predictions[1], labels, averaging_method=averaging_method)
 
-        if labeling_scheme == 'mutli':
+        if labeling_scheme == 'multi':
             overall_len = 0
             annotator_lens = {}
             metrics = {}
             pretrained_metrics = {}
-            if pretrained_basic_path != '':
-                pretrained_correct = 0
             for ann_idx, annotator in enumerate(self.dataset.annotators):
                 self.dataset.set_annotator_filter(annotator)
-                # batch_size needs to be 1
-                data_loader = torch.utils.data.DataLoader(
-                    self.dataset, batch_size=1, collate_fn=self.collate_wrapper)
 
                 # to calculate the f1 score, we need all predictions and labels by one annotator
-                predictions = []
-                pretrained_predictions = []
-                labels = []
-
-                for sample_idx, data in enumerate(data_loader, 1):
-                    # Prepare inputs to be passed to the model
-                    inp, label = data.input, data.target
-
-                    # Generate predictions
-                    if basic_only:
-                        output = model(inp)
-                    else:
-                        output = model(inp)[ann_idx]
-                    if pretrained_basic_path != '':
-                        pretrained_output = pretrained_model(inp)
-
-                    predictions.append(output.argmax(dim=1).item())
-                    labels.append(label.item())
-
-                    # document the prediction of the pretrained model
-                    if pretrained_basic_path != '':
-                        pretrained_predictions.append(pretrained_output.argmax(dim=1))
+                labels, predictions = self._predict([model, pretrained_model], batch_size=batch_size,
+                                                    head_idx=None if basic_only else ann_idx)
 
                 overall_len += len(self.dataset)
                 annotator_lens[annotator] = len(self.dataset)
 
                 # calculate metrics for annotator
-                metrics[annotator] = self.performance_measures(torch.tensor(predictions), torch.tensor(labels), averaging_method=averaging_method)
-                pretrained_metrics[annotator] = self.performance_measures(torch.tensor(
-                    pretrained_predictions), torch.tensor(labels), averaging_method=averaging_method)
+                metrics[annotator] = self.performance_measures(predictions[0], labels, averaging_method=averaging_method)
+                if pretrained_basic_path != '':
+                    pretrained_metrics[annotator] = self.performance_measures(
+                        predictions[1], labels, averaging_method=averaging_method)
+                else:
+                    pretrained_metrics[annotator] = (0.0, 0.0, 0.0, 0.0)
+            self.dataset.no_annotator_filter()
 
             # average over annotator metrics with weights relative to number of samples
             accuracy = sum([metrics[ann][0] * annotator_lens[ann] for ann in self.dataset.annotators]) / overall_len
@@ -937,6 +994,33 @@ class Solver(object):
 
         return accuracy, pretrained_accuracy, f1, pretrained_f1
 
+    def _predict(self, models, batch_size=1024, head_idx=None):
+        """
+        Labels and predictions [len(models), samples] of all models (None entries are skipped) on the current
+        mode and annotator filter of the dataset, batched and without autograd.
+        head_idx selects the output of one annotator head of the first model.
+        """
+        data_loader = torch.utils.data.DataLoader(
+            self.dataset, batch_size=batch_size, collate_fn=self.collate_wrapper)
+
+        samples = len(self.dataset)
+        labels = torch.empty(samples, dtype=torch.long, device=self.device)
+        predictions = torch.zeros(len(models), samples, dtype=torch.long, device=self.device)
+        start = 0
+        with torch.inference_mode():
+            for data in data_loader:
+                end = start + data.input.shape[0]
+                labels[start:end] = data.target
+                for i, model in enumerate(models):
+                    if model is None:
+                        continue
+                    output = model(data.input)
+                    if i == 0 and head_idx is not None:
+                        output = output[head_idx]
+                    predictions[i, start:end] = output.argmax(dim=1)
+                start = end
+        return labels, predictions
+
     @staticmethod
     def performance_measures(predictions, labels, averaging_method='macro'):
         if predictions.device.type == 'cuda' or labels.device.type == 'cuda':
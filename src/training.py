@@ -5,42 +5,263 @@ import pytz
 import datetime
 from scipy.special import exp10
 from itertools import product
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
 
 from solver import Solver
 from utils import get_writer, get_model_path
+from registry import RunRegistry
 
 
 def training_loop(dataset, batch_sizes, learning_rates, local_folder, epochs, solver_params,
-                  fit_params, stem='', root='../models', phase_path='', annotator_path=''):
-
-    # Training Loop
-    for batch_size, lr in product(batch_sizes, learning_rates):
-        # sub path
-        sub_path = f'{local_folder}/'
-        if phase_path is not '':
-            sub_path += f'{phase_path}/'
-        if annotator_path is not '':
-            sub_path += f'{annotator_path}/'
-
-        # For Documentation
-        current_time = datetime.datetime.now(pytz.timezone('Europe/Berlin')).strftime("%Y%m%d-%H%M%S")
-        hyperparams = {'batch': batch_size, 'lr': lr}
-        writer = get_writer(path=f'../logs/{sub_path}', stem=stem,
-                            current_time=current_time, params=hyperparams)
-
-        # Save model path
-        if local_folder != '' and not os.path.exists('../models/' + sub_path):
-            os.makedirs('../models/' + sub_path)
-        path = '../models/'
-        if local_folder != '':
-            path += sub_path
-        save_params = {'stem': stem, 'current_time': current_time, 'hyperparams': hyperparams}
-
-        # Training
-        solver = Solver(dataset, lr, batch_size, writer=writer, save_path_head=path, save_params=save_params,
-                        **solver_params)
-        model, f1 = solver.fit(**fit_params)
-
-        # Save model
-        model_path = get_model_path(path, stem, current_time, hyperparams, f1)
-        torch.save(model.state_dict(), model_path + f'_epoch{epochs}.pt')
\ No newline at end of file
+                  fit_params, stem='', root='../models', phase_path='', annotator_path='', num_workers=1,
+                  num_threads=None, registry=None, tags=None):
+    """
+    Train one model for every combination of batch size and learning rate.
+    With num_workers > 1 the combinations are trained in a pool of worker processes, each limited to
+    num_threads torch threads (default: cpu count / num_workers). The dataset is converted to columnar storage in
+    shared memory (see BaseDataset.share_memory) and workers are started by a fork server on cpu (spawned on cuda),
+    every worker writes its checkpoints and logs like a sequential run.
+    All checkpoints are recorded in the run registry (default: registry.sqlite in root) with the given tags
+    (e.g. task), the phase, annotator and dataset are added from phase_path, annotator_path and the dataset.
+    """
+    draws = list(product(batch_sizes, learning_rates))
+    if registry is None:
+        registry = RunRegistry(os.path.join(root, 'registry.sqlite'))
+    tags = {'phase': phase_path or None, 'annotator': annotator_path or None,
+            'dataset': type(dataset).__name__, **(tags or {})}
+    train_args = (local_folder, epochs, solver_params, fit_params, stem, root, phase_path, annotator_path,
+                  registry, tags)
+
+    if num_workers <= 1 or len(draws) <= 1:
+        for batch_size, lr in draws:
+            _train(dataset, batch_size, lr, *train_args)
+        return
+
+    if num_threads is None:
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    start_method = _get_start_method(solver_params)
+    dataset.share_memory()
+    # every draw gets its own seed, workers would otherwise share the random state of the fork server
+    seeds = np.random.randint(2 ** 31 - 1, size=len(draws))
+
+    with ProcessPoolExecutor(max_workers=min(num_workers, len(draws)), mp_context=mp.get_context(start_method),
+                             initializer=_init_worker, initargs=(dataset, num_threads)) as executor:
+        futures = [executor.submit(_train_worker, seed, batch_size, lr, *train_args)
+                   for seed, (batch_size, lr) in zip(seeds, draws)]
+        for future in futures:
+            future.result()
+
+
+def _get_start_method(solver_params):
+    # forking after torch started its thread pools can deadlock the workers, cuda can't be used in forked workers
+    return 'spawn' if solver_params.get('device', torch.device('cpu')).type == 'cuda' else 'forkserver'
+
+
+_worker_dataset = None
+
+
+def _init_worker(dataset, num_threads):
+    global _worker_dataset
+    _worker_dataset = dataset
+    torch.set_num_threads(num_threads)
+
+
+def _train_worker(seed, batch_size, lr, *train_args, **train_kwargs):
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    return _train(_worker_dataset, batch_size, lr, *train_args, **train_kwargs)
+
+
+def _train(dataset, batch_size, lr, local_folder, epochs, solver_params, fit_params, stem, root, phase_path,
+           annotator_path, registry, tags, current_time=None, save_rung=False):
+    """
+    Train one model and save it, returns its f1 and checkpoint path. With save_rung the model is an intermediate
+    result of successive halving, it is saved with its optimizer state in the rungs directory to be resumed from.
+    """
+    # sub path
+    sub_path = f'{local_folder}/'
+    if phase_path != '':
+        sub_path += f'{phase_path}/'
+    if annotator_path != '':
+        sub_path += f'{annotator_path}/'
+
+    # For Documentation
+    if current_time is None:
+        current_time = _current_time()
+    hyperparams = {'batch': batch_size, 'lr': lr}
+    writer = get_writer(path=f'../logs/{sub_path}', stem=stem,
+                        current_time=current_time, params=hyperparams)
+
+    # Save model path
+    if local_folder != '':
+        os.makedirs('../models/' + sub_path, exist_ok=True)
+    path = '../models/'
+    if local_folder != '':
+        path += sub_path
+    save_params = {'stem': stem, 'current_time': current_time, 'hyperparams': hyperparams, 'tags': tags}
+
+    # Training
+    solver = Solver(dataset, lr, batch_size, writer=writer, save_path_head=path, save_params=save_params,
+                    registry=registry, **solver_params)
+    model, f1 = solver.fit(**fit_params)
+
+    if save_rung:
+        os.makedirs(f'{path}rungs', exist_ok=True)
+        model_path = f'{path}rungs/' + get_model_path('', stem, current_time, hyperparams) + \
+            f'_epoch{fit_params["epochs"]}.pt'
+        solver.save_checkpoint(model, model_path)
+        solver.checkpoint_writer.close()
+        writer.close()
+        return f1, model_path
+
+    # Save model
+    model_path = get_model_path(path, stem, current_time, hyperparams, f1) + f'_epoch{epochs}.pt'
+    solver.checkpoint_writer.save(model.state_dict(), model_path)
+    solver.checkpoint_writer.close()
+    registry.record(model_path, epoch=epochs, f1=f1, metrics={'f1': f1}, hyperparams=hyperparams, **tags)
+    # worker processes exit without running the writer's exit handlers
+    writer.close()
+    return f1, model_path
+
+
+def _current_time():
+    return datetime.datetime.now(pytz.timezone('Europe/Berlin')).strftime("%Y%m%d-%H%M%S")
+
+
+def _remove_checkpoint(model_path, registry):
+    for path in [model_path, model_path[:-len('.pt')] + '_optimizer.pt']:
+        if os.path.exists(path):
+            os.remove(path)
+    registry.remove(model_path)
+
+
+class _InlineExecutor(object):
+    """Runs every submitted job right away in this process, used in place of a pool of one worker"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def successive_halving_loop(dataset, batch_sizes, learning_rates, local_folder, epochs, solver_params, fit_params,
+                            min_epochs=10, reduction_factor=3, stem='', root='../models', phase_path='',
+                            annotator_path='', num_workers=1, num_threads=None, registry=None, tags=None):
+    """
+    Asynchronous successive halving (ASHA) over all combinations of batch size and learning rate.
+    Every combination is trained for min_epochs first. A combination is promoted to the next rung
+    (reduction_factor times the epochs, up to epochs) as soon as its validation f1 of Solver.fit is among the top
+    1 / reduction_factor of the results of its rung so far, so workers never wait for a rung to complete.
+    Once all combinations are started and no training is left running, at least the best result of every rung
+    is promoted, so the best combination always reaches epochs. A last rung that would be less than
+    sqrt(reduction_factor) times the rung before replaces that rung.
+    Training resumes from the checkpoint of the previous rung (kept in <models path>/rungs while the loop runs),
+    and only models reaching epochs are saved and recorded like in training_loop.
+    Workers are set up like in training_loop. Returns (batch size, lr, epochs trained, f1) of every combination,
+    sorted by epochs trained and f1.
+    """
+    draws = list(product(batch_sizes, learning_rates))
+    rungs = []
+    rung_epochs = min_epochs
+    while rung_epochs < epochs:
+        rungs.append(rung_epochs)
+        rung_epochs *= reduction_factor
+    # e.g. 10, 30, 100 instead of 10, 30, 90, 100
+    if len(rungs) > 0 and epochs < rungs[-1] * np.sqrt(reduction_factor):
+        rungs.pop()
+    rungs.append(epochs)
+
+    if registry is None:
+        registry = RunRegistry(os.path.join(root, 'registry.sqlite'))
+    tags = {'phase': phase_path or None, 'annotator': annotator_path or None,
+            'dataset': type(dataset).__name__, **(tags or {})}
+    # the logs and checkpoints of a combination keep their name across rungs
+    current_time = _current_time()
+
+    results = [{} for _ in rungs]
+    promoted = [set() for _ in rungs]
+    checkpoints = {}
+    started = 0
+
+    def next_job(idle):
+        nonlocal started
+        # rungs with fewer than reduction_factor results still promote their best one at the end
+        finishing = idle and started == len(draws)
+        # promote from the highest rung first
+        for rung in reversed(range(len(rungs) - 1)):
+            ranked = sorted(results[rung], key=lambda draw: -results[rung][draw])
+            num_promoted = len(ranked) // reduction_factor
+            if finishing:
+                num_promoted = max(1, num_promoted)
+            for draw in ranked[:num_promoted]:
+                if draw not in promoted[rung]:
+                    promoted[rung].add(draw)
+                    return draw, rung + 1
+        if started < len(draws):
+            started += 1
+            return started - 1, 0
+        return None
+
+    if num_workers <= 1:
+        _init_worker(dataset, torch.get_num_threads())
+        executor, max_running = _InlineExecutor(), 1
+    else:
+        if num_threads is None:
+            num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        start_method = _get_start_method(solver_params)
+        dataset.share_memory()
+        executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=mp.get_context(start_method),
+                                       initializer=_init_worker, initargs=(dataset, num_threads))
+        max_running = num_workers
+
+    with executor:
+        running = {}
+        while True:
+            while len(running) < max_running:
+                job = next_job(idle=len(running) == 0)
+                if job is None:
+                    break
+                draw, rung = job
+                batch_size, lr = draws[draw]
+                rung_fit_params = {**fit_params, 'return_f1': True, 'epochs': rungs[rung], 'total_epochs': epochs}
+                if rung > 0:
+                    rung_fit_params.update({'start_epoch': rungs[rung - 1], 'resume_path': checkpoints[draw]})
+                train_args = (local_folder, epochs, solver_params, rung_fit_params, stem, root, phase_path,
+                              annotator_path, registry, tags)
+                future = executor.submit(_train_worker, np.random.randint(2 ** 31 - 1), batch_size, lr, *train_args,
+                                         current_time=current_time, save_rung=rung < len(rungs) - 1)
+                running[future] = (draw, rung)
+            if len(running) == 0:
+                break
+
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                draw, rung = running.pop(future)
+                f1, model_path = future.result()
+                results[rung][draw] = f1
+                # the checkpoint of the previous rung is not needed anymore once training resumed from it
+                if rung > 0:
+                    _remove_checkpoint(checkpoints[draw], registry)
+                checkpoints[draw] = model_path
+
+    # checkpoints of the combinations that were not promoted to the last rung
+    for draw, model_path in checkpoints.items():
+        if draw not in results[-1]:
+            _remove_checkpoint(model_path, registry)
+
+    summary = []
+    for draw, (batch_size, lr) in enumerate(draws):
+        rung = max([rung for rung in range(len(rungs)) if draw in results[rung]], default=None)
+        if rung is not None:
+            summary.append((batch_size, lr, rungs[rung], results[rung][draw]))
+    return sorted(summary, key=lambda result: (-result[2], -result[3]))
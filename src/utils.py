@@ -1,8 +1,12 @@
 import os
+import hashlib
+import tempfile
 import numpy as np
 from scipy.special import exp10
 from torch.utils.tensorboard import SummaryWriter
 
+from registry import parse_checkpoint_name
+
 
 def get_writer(path, stem, current_time, params):
     if stem is '':
@@ -33,7 +37,7 @@ def get_model_path(path, stem, current_time, params, f1=0.0):
     return path
 
 
-def get_pseudo_model_path(pseudo_root, annotator, phase=''):
+def get_pseudo_model_path(pseudo_root, annotator, phase='', registry=None):
     """
     This function has to have an annotator argument,
     all other arguments should be provided to the solver separately.
@@ -41,16 +45,10 @@ def get_pseudo_model_path(pseudo_root, annotator, phase=''):
     It assumes all model paths start with the f1 score and use '_' as a separator!
     """
     root = f'{pseudo_root}/'
-    if phase is not '':
+    if phase != '':
         root += f'{phase}/'
     root += f'{annotator}'
-    f1s = []
-    for model_path in os.listdir(root):
-        f1, rest = (lambda x: (x[0], x[1:]))(model_path.split('_'))
-        f1s.append(float(f1))
-    f1s = np.asarray(f1s)
-    idx = f1s.argmax()
-    return f'{root}/{os.listdir(root)[idx]}'
+    return get_best_model_path(root, registry=registry)
 
 
 def get_pseudo_model_path_tripadvisor(pseudo_root, annotator, phase=''):
@@ -67,20 +65,74 @@ def get_pseudo_model_path_tripadvisor(pseudo_root, annotator, phase=''):
     return f'{pseudo_root}/{path_dict[annotator]}'
 
 
-def get_best_model_path(path_to_models):
+def get_model_file_names(path_to_models, registry=None):
+    """
+    File names of the checkpoints in path_to_models, best f1 first and those saved without f1 last.
+    Uses the run registry if given (the directory is only indexed again once it changed, see
+    RunRegistry.index_directory), otherwise scans the directory.
+    """
+    if registry is not None:
+        registry.index_directory(path_to_models)
+        return registry.file_names(path_to_models)
+    checkpoints = [(file_name, parse_checkpoint_name(file_name)) for file_name in os.listdir(path_to_models)]
+    checkpoints = [(file_name, parsed[0]) for file_name, parsed in checkpoints if parsed is not None]
+    checkpoints.sort(key=lambda checkpoint: (checkpoint[1] is None, -(checkpoint[1] or 0.0)))
+    return [file_name for file_name, _ in checkpoints]
+
+
+def get_best_model_path(path_to_models, registry=None):
     """
     This function has to have an annotator argument,
     all other arguments should be provided to the solver separately.
 
     It assumes all model paths start with the f1 score and use '_' as a separator!
     """
-    f1s = []
-    for model_path in os.listdir(path_to_models):
-        f1, rest = (lambda x: (x[0], x[1:]))(model_path.split('_'))
-        f1s.append(float(f1))
-    f1s = np.asarray(f1s)
-    idx = f1s.argmax()
-    return f'{path_to_models}/{os.listdir(path_to_models)[idx]}'
+    if registry is not None:
+        registry.index_directory(path_to_models)
+        file_name = registry.best_file_name(path_to_models)
+    else:
+        file_names = get_model_file_names(path_to_models)
+        file_name = file_names[0] if len(file_names) != 0 else None
+    if file_name is None:
+        raise FileNotFoundError(f'No checkpoints in {path_to_models}')
+    return f'{path_to_models}/{file_name}'
+
+
+def get_file_hash(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_pseudo_label_cache_path(cache_root, model_path, dataset, pseudo_annotator):
+    """
+    Pseudo labels only depend on the checkpoint and the data, so the cache file is keyed by
+    a content hash of the checkpoint and the split signature of the dataset.
+    """
+    key = hashlib.sha1(f'{get_file_hash(model_path)}_{dataset.split_signature()}'.encode()).hexdigest()
+    return f'{cache_root}/{type(dataset).__name__}_{pseudo_annotator}_{key[:16]}.npz'
+
+
+def load_pseudo_label_map(path):
+    with np.load(path) as cache:
+        return dict(zip(cache['texts'].tolist(), cache['labels'].tolist()))
+
+
+def save_pseudo_label_map(path, pseudo_label_map):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary file of this writer first, so concurrent solvers never load a half written cache
+    fd, temp_path = tempfile.mkstemp(prefix=f'{os.path.basename(path)}.', suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, texts=np.array(list(pseudo_label_map.keys()), dtype=str),
+                     labels=np.array(list(pseudo_label_map.values()), dtype=np.int64))
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
 
 
 def get_learning_rates(start, end, num_draws):
@@ -0,0 +1,45 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import training  # noqa: E402
+
+
+def fake_train_worker(seed, batch_size, lr, local_folder, epochs, solver_params, fit_params, stem, root, phase_path,
+                      annotator_path, registry, tags, current_time=None, save_rung=False):
+    """Stands in for training: the f1 grows with the epochs and is best for the learning rate closest to 1e-3"""
+    f1 = fit_params['epochs'] / (fit_params['epochs'] + 10.0) - abs(lr - 1e-3)
+    directory = os.path.join(root, 'rungs' if save_rung else 'final')
+    os.makedirs(directory, exist_ok=True)
+    model_path = os.path.join(directory, f'{f1:.5f}_batch{batch_size}_lr{lr}_epoch{fit_params["epochs"]}.pt')
+    open(model_path, 'w').close()
+    return f1, model_path
+
+
+@pytest.mark.parametrize('num_draws, epochs, final_rung', [(10, 100, 100), (20, 100, 100), (20, 3000, 3000)])
+def test_successive_halving_reaches_last_rung(tmp_path, monkeypatch, num_draws, epochs, final_rung):
+    monkeypatch.setattr(training, '_train_worker', fake_train_worker)
+    learning_rates = [1e-3 * (1 + i) for i in range(num_draws)]
+
+    summary = training.successive_halving_loop(None, [16], learning_rates, 'asha', epochs, {}, {'epochs': epochs},
+                                               root=str(tmp_path))
+
+    assert len(summary) == num_draws
+    batch_size, lr, reached_epochs, _ = summary[0]
+    assert reached_epochs == final_rung
+    assert lr == 1e-3
+    # the best model is kept, all intermediate checkpoints are removed
+    assert len(os.listdir(tmp_path / 'final')) == sum(result[2] == final_rung for result in summary)
+    assert os.listdir(tmp_path / 'rungs') == []
+
+
+def test_successive_halving_merges_short_last_rung(tmp_path, monkeypatch):
+    monkeypatch.setattr(training, '_train_worker', fake_train_worker)
+
+    summary = training.successive_halving_loop(None, [16], [1e-3 * (1 + i) for i in range(27)], 'asha', 100, {},
+                                               {'epochs': 100}, root=str(tmp_path))
+
+    assert sorted(set(result[2] for result in summary)) == [10, 30, 100]